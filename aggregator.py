@@ -119,8 +119,8 @@ class ProofPile(datasets.GeneratorBasedBuilder):
         # It can accept any type or nested list/dict and will give back the same structure with the url replaced with path to local files.
         # By default the archives will be extracted and a path to a cached folder where they are extracted is returned instead of the archive
 
-        self.archived_configs = ["arxiv", "wiki"]
-        self.jsonl_configs = ["stack-exchange", "math-dataset", "books", "formal"]
+        self.archived_configs = ["arxiv"]
+        self.jsonl_configs = ["stack-exchange", "math-dataset", "books", "formal", "wiki"]
 
         if self.config.name in self.archived_configs: 
             if self.config.name=="arxiv": 
@@ -137,9 +137,6 @@ class ProofPile(datasets.GeneratorBasedBuilder):
             if self.config.name=="math-dataset": 
                 train_paths = ["math-dataset/train.tar.gz"]
                 val_paths = ["math-dataset/val.tar.gz"]
-            if self.config.name=="wiki": 
-                train_paths = ["wiki/proofwiki.tar.gz", "wiki/wikipedia.tar.gz"]
-                val_paths = ["wiki/proofwiki_val.tar.gz"]
 
             train_files = itertools.chain.from_iterable(dl_manager.iter_archive(dl_manager.download(x)) for x in train_paths)
             val_files = itertools.chain.from_iterable(dl_manager.iter_archive(dl_manager.download(x)) for x in val_paths)
@@ -179,6 +176,9 @@ class ProofPile(datasets.GeneratorBasedBuilder):
                 libs = ["afp",  "coq", "hol", "lean", "mizar", "setmm"]
                 train_paths = [os.path.join("./formal", x + "_train.jsonl.gz") for x in libs]
                 val_paths = [os.path.join("./formal", x + "_val.jsonl.gz") for x in libs]
+            elif self.config.name=="wiki": 
+                train_paths = ["./wiki/proofwiki_train.jsonl.gz", "./wiki/wikipedia_train.jsonl.gz"]
+                val_paths = ["./wiki/proofwiki_val.jsonl.gz", "./wiki/wikipedia_val.jsonl.gz"]
  
             train_files = itertools.chain.from_iterable([dl_manager.download_and_extract(x)] for x in train_paths)
             val_files = itertools.chain.from_iterable([dl_manager.download_and_extract(x)] for x in val_paths)
@@ -0,0 +1,474 @@
+"""
+Times the hot paths of the pipeline on deterministic synthetic inputs: arXiv
+TeX with comments, bibliographies and mixed encodings, Stack Exchange
+Posts.xml and Comments.xml with html bodies, ProofWiki-style json, and nested
+tar.gz shards.
+
+    python benchmark.py                              # everything
+    python benchmark.py strip_html fromXML --scale 4
+    python benchmark.py --out benchmarks.jsonl       # append results, to compare runs
+
+Every benchmark runs in a fresh process, so its peak RSS is its own, and
+prints one json line with docs/s, MB/s and peak RSS. Setup is not timed.
+Benchmarks whose dependencies are not installed are reported as skipped.
+"""
+import io
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import tarfile
+import argparse
+import resource
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from xml.sax.saxutils import quoteattr
+from concurrent.futures import ProcessPoolExecutor
+
+SEED = 0
+
+WORDS = (
+    "theorem lemma proof let suppose then hence every group ring field module "
+    "space continuous compact manifold prime integer matrix vector norm bounded "
+    "Poincaré Erdős Gödel Schrödinger sequence converges uniformly measure"
+).split()
+
+
+def _sentence(rng, n=14):
+    words = [rng.choice(WORDS) for _ in range(n)]
+    if rng.random() < 0.5:
+        words.insert(rng.randrange(n), f"$x_{{{rng.randrange(9)}}}^2 + y \\leq \\epsilon$")
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng, sentences=6):
+    return " ".join(_sentence(rng) for _ in range(sentences))
+
+
+def synthetic_tex(rng, sections=8):
+    parts = [
+        "\\documentclass{amsart}\n",
+        "% this preamble comment should be stripped\n",
+        "\\usepackage{amsmath} % so should this one\n",
+        "\\begin{document}\n",
+    ]
+    for i in range(sections):
+        parts.append(f"\\section{{{_sentence(rng, 4)}}}\n")
+        for _ in range(rng.randrange(2, 6)):
+            parts.append(_paragraph(rng) + " About 50\\% of cases. % a comment\n\n")
+        if rng.random() < 0.5:
+            parts.append("\\begin{equation}\n\\int_0^1 f(x)\\,dx = 1\n\\end{equation}\n\n\n\n")
+    bib = rng.randrange(3)
+    if bib == 0:
+        parts.append("\\begin{thebibliography}{9}\n\\bibitem{a} A. Author, " + _sentence(rng)
+                + "\n\\end{thebibliography}\n")
+    elif bib == 1:
+        parts.append("\\begin{bibdiv}\n\\begin{biblist}\n\\bib{a}{article}{title={"
+                + _sentence(rng) + "}}\n\\end{biblist}\n\\end{bibdiv}\n")
+    else:
+        parts.append("\\Refs\n\\ref\\no 1 " + _sentence(rng) + "\n\\endRefs\n")
+    parts.append("\\end{document}\nTrailing junk after the document.\n")
+    return "".join(parts)
+
+
+def write_tex_files(directory, rng, n, encodings=("utf-8", "utf-8", "latin-1", "utf-16")):
+    """
+    Writes `n` TeX files cycling through `encodings`, returns their total size.
+    """
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for i in range(n):
+        path = os.path.join(directory, f"{i}.tex")
+        with open(path, "w", encoding=encodings[i % len(encodings)], errors="replace") as f:
+            f.write(synthetic_tex(rng))
+        total += os.path.getsize(path)
+    return total
+
+
+def _html_body(rng):
+    return (
+        f"<p>{_paragraph(rng)}</p>\n<p>{_paragraph(rng, 3)} <em>{rng.choice(WORDS)}</em></p>\n"
+        f"<ul><li>{_sentence(rng)}</li><li>{_sentence(rng)}</li></ul>\n"
+        "<pre><code>def f(x):\n    return x &lt; 2\n</code></pre>\n"
+    )
+
+
+def _row(**attrs):
+    return "  <row " + " ".join(f"{k}={quoteattr(str(v))}" for k, v in attrs.items()) + " />\n"
+
+
+def write_stack_exchange(directory, rng, n_questions):
+    """
+    Writes Posts.xml and Comments.xml in the layout of the Stack Exchange dumps.
+    """
+    os.makedirs(directory, exist_ok=True)
+    date = "2020-01-01T00:00:00.000"
+    post_id = 0
+    comment_id = 0
+    with open(os.path.join(directory, "Posts.xml"), "w", encoding="utf-8") as posts, \
+            open(os.path.join(directory, "Comments.xml"), "w", encoding="utf-8") as comments:
+        posts.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        comments.write('<?xml version="1.0" encoding="utf-8"?>\n<comments>\n')
+        for _ in range(n_questions):
+            post_id += 1
+            question_id = post_id
+            n_answers = rng.randrange(4)
+            posts.write(_row(Id=question_id, PostTypeId=1, Score=rng.randrange(-2, 30),
+                Body=_html_body(rng), Title=_sentence(rng, 8), LastActivityDate=date,
+                Tags="<algebra><topology>", AnswerCount=n_answers))
+            for _ in range(n_answers):
+                post_id += 1
+                posts.write(_row(Id=post_id, PostTypeId=2, ParentId=question_id,
+                    Score=rng.randrange(-2, 20), Body=_html_body(rng), LastActivityDate=date))
+            for _ in range(rng.randrange(3)):
+                comment_id += 1
+                comments.write(_row(Id=comment_id, PostId=question_id,
+                    Score=rng.randrange(5), Text=_sentence(rng), UserId=rng.randrange(100),
+                    CreationDate=date))
+        posts.write("</posts>\n")
+        comments.write("</comments>\n")
+    return sum(os.path.getsize(os.path.join(directory, x)) for x in ("Posts.xml", "Comments.xml"))
+
+
+def write_proofwiki(path, rng, n):
+    """
+    Writes a json file shaped like the NaturalProofs ProofWiki dump.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    theorems = [{
+        "id": i,
+        "label": _sentence(rng, 4),
+        "categories": ["Algebra/Groups", "Topology"],
+        "toplevel_categories": ["Algebra"],
+        "contents": [_sentence(rng) for _ in range(3)],
+        "proofs": [{"contents": [_paragraph(rng, 3) for _ in range(2)], "refs": []}],
+        "refs": [],
+    } for i in range(n)]
+    definitions = [{
+        "id": n + i,
+        "label": _sentence(rng, 3),
+        "categories": ["Definitions"],
+        "contents": [_sentence(rng) for _ in range(2)],
+    } for i in range(n // 4)]
+    data = {"dataset": {"theorems": theorems, "definitions": definitions,
+        "others": [], "retrieval_examples": list(range(n))}, "splits": {}}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return n + n // 4, os.path.getsize(path)
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, fileobj=io.BytesIO(data))
+
+
+def write_arxiv_tarball(directory, rng, n, yymm="1001"):
+    """
+    Writes an arXiv source shard: a tar of gzipped articles, each either a
+    single TeX file or a tar of several. Returns the shard name and math ids.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"arXiv_src_{yymm}_001.tar"
+    math_ids = {}
+    with tarfile.open(os.path.join(directory, name), "w") as outer:
+        for i in range(n):
+            eyed = f"{yymm}.{i:04d}"
+            math_ids[eyed] = True
+            tex = synthetic_tex(rng).encode("utf-8")
+            if i % 3 == 0:
+                inner = io.BytesIO()
+                with tarfile.open(fileobj=inner, mode="w:gz") as article:
+                    _add_bytes(article, "main.tex", tex)
+                    _add_bytes(article, "appendix.tex", synthetic_tex(rng).encode("utf-8"))
+                    _add_bytes(article, "figure.eps", b"%!PS\n" * 200)
+                data = inner.getvalue()
+            else:
+                data = gzip.compress(tex)
+            _add_bytes(outer, f"{yymm}/{eyed}.gz", data)
+    return name, math_ids
+
+
+def _dir_bytes(directory):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(directory) for f in fs)
+
+
+def bench_clean_tex_file(workdir, scale):
+    from fetch_arxiv import clean_tex_file
+
+    n = 200 * scale
+    size = write_tex_files(os.path.join(workdir, "tex"), random.Random(SEED), n)
+    paths = [os.path.join(workdir, "tex", f"{i}.tex") for i in range(n)]
+    return n, size, lambda: [clean_tex_file(x) for x in paths]
+
+
+def bench_clean_tex_file_some_more(workdir, scale):
+    from fetch_arxiv import clean_tex_file_some_more
+
+    n = 50 * scale
+    size = write_tex_files(os.path.join(workdir, "tex"), random.Random(SEED), n, ("utf-8",))
+    paths = [os.path.join(workdir, "tex", f"{i}.tex") for i in range(n)]
+    return n, size, lambda: [clean_tex_file_some_more(x) for x in paths]
+
+
+def _stack_exchange_rows(workdir, scale):
+    from xml.etree import ElementTree
+
+    size = write_stack_exchange(workdir, random.Random(SEED), 2000 * scale)
+    return ElementTree.parse(os.path.join(workdir, "Posts.xml")).getroot(), size
+
+
+def bench_fromXML(workdir, scale):
+    from fetch_stack_exchange import fromXML, Post
+
+    rows, _ = _stack_exchange_rows(workdir, scale)
+    rows = list(rows)
+    size = sum(len(x.attrib.get("Body", "")) for x in rows)
+    return len(rows), size, lambda: [fromXML(Post, x) for x in rows]
+
+
+def bench_questions(workdir, scale):
+    import fetch_stack_exchange
+
+    size = write_stack_exchange(workdir, random.Random(SEED), 2000 * scale)
+    fetch_stack_exchange.DATA_DIR = workdir
+    fetch_stack_exchange.ARCHIVE_PATH = None
+    with open(os.path.join(workdir, "Posts.xml"), encoding="utf-8") as f:
+        n = sum(1 for line in f if line.startswith("  <row"))
+    return n, size, fetch_stack_exchange.questions
+
+
+def bench_strip_html(workdir, scale):
+    from fetch_stack_exchange import strip_html
+
+    rows, _ = _stack_exchange_rows(workdir, scale)
+    bodies = [x.attrib["Body"] for x in rows]
+    return len(bodies), sum(map(len, bodies)), lambda: [strip_html(x) for x in bodies]
+
+
+def bench_text_of_post(workdir, scale):
+    import fetch_stack_exchange
+
+    write_stack_exchange(workdir, random.Random(SEED), 1000 * scale)
+    fetch_stack_exchange.DATA_DIR = workdir
+    fetch_stack_exchange.ARCHIVE_PATH = None
+    posts = list(fetch_stack_exchange.questions().values())
+    size = sum(len(x.Body) + sum(len(a.Body) for a in x.Answers) for x in posts)
+    return len(posts), size, lambda: [fetch_stack_exchange.text_of_post(x) for x in posts]
+
+
+def _arxiv_instances(scale):
+    rng = random.Random(SEED)
+    return [{"text": synthetic_tex(rng), "meta": "{}"} for _ in range(500 * scale)]
+
+
+def bench_process_arxiv_text(workdir, scale):
+    from make_jsons import process_arxiv_text
+
+    instances = _arxiv_instances(scale)
+    size = sum(len(x["text"]) for x in instances)
+    return len(instances), size, lambda: [process_arxiv_text(x) for x in instances]
+
+
+def bench_filter_arxiv_text(workdir, scale):
+    from make_jsons import filter_arxiv_text
+
+    instances = _arxiv_instances(scale)
+    size = sum(len(x["text"]) for x in instances)
+    return len(instances), size, lambda: [filter_arxiv_text(x) for x in instances]
+
+
+def bench_noise_score(workdir, scale):
+    import noise_filter
+
+    rng = random.Random(SEED)
+    model = noise_filter.NgramModel(bits=20).fit(synthetic_tex(rng) for _ in range(200))
+    texts = [x["text"] for x in _arxiv_instances(scale)]
+    size = sum(len(x) for x in texts)
+    return len(texts), size, lambda: [model.perplexity(x) for x in texts]
+
+
+def _generate_examples(config_name, data_files):
+    from aggregator import ProofPile
+
+    builder = SimpleNamespace(config=SimpleNamespace(name=config_name),
+        archived_configs=["arxiv"],
+        jsonl_configs=["stack-exchange", "math-dataset", "books", "formal", "wiki"])
+    return ProofPile._generate_examples(builder, data_files)
+
+
+def bench_generate_examples_archived(workdir, scale):
+    import aggregator  # noqa: F401, skip early if datasets is missing
+    from utils import make_archive
+
+    n = 500 * scale
+    month = os.path.join(workdir, "1001")
+    size = write_tex_files(month, random.Random(SEED), n, ("utf-8",))
+    make_archive(month)
+
+    def run():
+        with tarfile.open(month + ".tar.gz", "r|gz") as tar:
+            members = ((x.name, tar.extractfile(x)) for x in tar if x.isfile())
+            for _ in _generate_examples("arxiv", members):
+                pass
+    return n, size, run
+
+
+def bench_generate_examples_jsonl(workdir, scale):
+    import aggregator  # noqa: F401, skip early if datasets is missing
+
+    rng = random.Random(SEED)
+    paths = []
+    n = 0
+    for i in range(4):
+        path = os.path.join(workdir, f"shard_{i}.jsonl")
+        with open(path, "w") as f:
+            for _ in range(250 * scale):
+                f.write(json.dumps({"text": synthetic_tex(rng), "meta": {"file": path}}) + "\n")
+                n += 1
+        paths.append(path)
+    size = sum(map(os.path.getsize, paths))
+
+    def run():
+        for _ in _generate_examples("books", paths):
+            pass
+    return n, size, run
+
+
+def bench_make_archive(workdir, scale):
+    from utils import make_archive
+
+    n = 1000 * scale
+    month = os.path.join(workdir, "1001")
+    size = write_tex_files(month, random.Random(SEED), n, ("utf-8",))
+    return n, size, lambda: make_archive(month)
+
+
+def bench_proofwiki(workdir, scale):
+    import fetch_wiki
+
+    n, size = write_proofwiki(os.path.join(workdir, "naturalproofs", "proofwiki.json"),
+            random.Random(SEED), 5000 * scale)
+    os.chdir(workdir)
+    return n, size, lambda: fetch_wiki.proofwiki(testing=True)
+
+
+def bench_process_tarball(workdir, scale):
+    from fetch_arxiv import process_tarball
+
+    n = 100 * scale
+    name, math_ids = write_arxiv_tarball(workdir, random.Random(SEED), n)
+    size = os.path.getsize(os.path.join(workdir, name))
+    return n, size, lambda: process_tarball(name, workdir, math_ids)
+
+
+BENCHMARKS = {
+    "clean_tex_file": bench_clean_tex_file,
+    "clean_tex_file_some_more": bench_clean_tex_file_some_more,
+    "fromXML": bench_fromXML,
+    "questions": bench_questions,
+    "strip_html": bench_strip_html,
+    "text_of_post": bench_text_of_post,
+    "process_arxiv_text": bench_process_arxiv_text,
+    "filter_arxiv_text": bench_filter_arxiv_text,
+    "noise_score": bench_noise_score,
+    "generate_examples_archived": bench_generate_examples_archived,
+    "generate_examples_jsonl": bench_generate_examples_jsonl,
+    "make_archive": bench_make_archive,
+    "proofwiki": bench_proofwiki,
+    "process_tarball": bench_process_tarball,
+}
+
+
+def _peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def run_benchmark(name, scale=1):
+    """
+    Runs in a fresh worker process. Returns the result record of `name`.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    cwd = os.getcwd()
+    record = {"name": name, "scale": scale}
+    # the benchmarked code prints per document, which is not what we measure
+    stdout = sys.stdout
+    try:
+        sys.stdout = open(os.devnull, "w")
+        try:
+            docs, size, run = BENCHMARKS[name](workdir, scale)
+        except ImportError as e:
+            record["skipped"] = f"missing dependency: {e.name or e}"
+            return record
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        run()
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    record.update({
+        "docs": docs,
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "cpu_seconds": round(cpu_seconds, 4),
+        "docs_per_s": round(docs / seconds, 1),
+        "mb_per_s": round(size / 2**20 / seconds, 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    })
+    return record
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proof-pile hot paths.")
+    parser.add_argument("names", nargs="*", help=f"any of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--scale", type=int, default=1, help="multiplies every input size")
+    parser.add_argument("--out", default=None, help="jsonl file to append results to")
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            raise KeyError(f"unknown benchmark {name}")
+
+    # the benchmarked code reports to metrics, keep that out of the build's log
+    os.environ.setdefault("PROOF_PILE_METRICS", os.devnull)
+
+    run = {"run": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": _git_revision(),
+            "python": sys.version.split()[0], "cpus": os.cpu_count()}
+    out = open(args.out, "a") if args.out else None
+    try:
+        for name in args.names or BENCHMARKS:
+            with ProcessPoolExecutor(1) as executor:
+                record = {**run, **executor.submit(run_benchmark, name, args.scale).result()}
+            line = json.dumps(record)
+            print(line, flush=True)
+            if out is not None:
+                out.write(line + "\n")
+                out.flush()
+    finally:
+        if out is not None:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Builds the proof-pile from scratch, replacing the sequential download_all.sh.
+
+Every source and stage is a `Task` with declared inputs and outputs. Tasks whose
+dependencies are done run concurrently, in one of three pools: "io" tasks are
+mostly waiting on the network, "cpu" tasks are mostly parsing, "mem" tasks
+hold a whole source in memory, and each pool has its own concurrency limit.
+Tasks size their own process pools to a share of the CPUs, one per "cpu"
+worker, see `utils.task_workers`. A task is skipped when its outputs are
+newer than its inputs and its last run succeeded, so a task without outputs
+always runs. Every task is a `metrics` stage, and the build ends with a
+summary of the metrics log.
+
+    python build.py                      # everything
+    python build.py lean coq --force     # just these, even if up to date
+    python build.py --dry-run            # show what would run
+    python build.py lean --profile all   # profile every stage, see profiler.py
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+from dataclasses import dataclass, field
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+STAMP_DIR = ".build"
+
+
+@dataclass
+class Task:
+    name: str
+    target: str  # "module:function", imported in the worker
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    deps: List[str] = field(default_factory=list)
+    kind: str = "io"  # "io", "cpu" or "mem"
+    group: str = ""  # the source or stage, e.g. "books", a subcommand of `proofpile`
+
+    @property
+    def stamp(self):
+        return os.path.join(STAMP_DIR, self.name + ".done")
+
+    def up_to_date(self):
+        # without outputs there is nothing to tell a finished run from a stale one
+        if not self.outputs or not os.path.exists(self.stamp):
+            return False
+        if any(not os.path.exists(x) for x in self.outputs):
+            return False
+        built = min(os.path.getmtime(x) for x in self.outputs + [self.stamp])
+        return all(os.path.getmtime(x) <= built for x in self.inputs if os.path.exists(x))
+
+
+def _run(task):
+    """
+    Runs in a worker process. Returns (start, end) wall clock times.
+    """
+    start = time.time()
+    module_name, fn_name = task.target.split(":")
+    with metrics.stage(task.name, kind=task.kind):
+        fn = getattr(importlib.import_module(module_name), fn_name)
+        fn(*task.args, **task.kwargs)
+    os.makedirs(STAMP_DIR, exist_ok=True)
+    with open(task.stamp, "w") as f:
+        f.write(str(time.time()))
+    return start, time.time()
+
+
+def _split_outputs(prefix, names):
+    return [f"{prefix}/{x}_{split}.jsonl.gz" for x in names for split in ("train", "val")]
+
+
+def tasks(creds):
+    out = []
+
+    for name in ["napkin", "cring", "stacks", "hott", "stein"]:
+        out.append(Task(name, f"fetch_books_and_formal:{name}", args=(creds,),
+            outputs=_split_outputs("books", [name]), group="books"))
+    for name in ["trench", "cam"]:
+        out.append(Task(name, f"fetch_books_and_formal:{name}",
+            outputs=_split_outputs("books", [name]), group="books"))
+    for name in ["mizar", "setmm", "coq", "lean"]:
+        out.append(Task(name, f"fetch_books_and_formal:{name}", args=(creds,),
+            outputs=_split_outputs("formal", [name]), group="formal"))
+    for name in ["afp", "hol"]:
+        out.append(Task(name, f"fetch_books_and_formal:{name}",
+            outputs=_split_outputs("formal", [name]), group="formal"))
+
+    out.append(Task("math-dataset", "fetch_math_dataset:main",
+        outputs=["math-dataset/train.jsonl.gz", "math-dataset/val.jsonl.gz",
+            "math-dataset/test.jsonl.gz"], group="math-dataset"))
+
+    sites = [
+        ("mathoverflow.net", "math_overflow"),
+        ("math.stackexchange.com", "math_stack_exchange"),
+        ("physics.stackexchange.com", "physics_stack_exchange"),
+        ("cstheory.stackexchange.com", "cstheory_stack_exchange"),
+        ("datascience.stackexchange.com", "datascience_stack_exchange"),
+        ("proofassistants.stackexchange.com", "proofassistants_stack_exchange"),
+    ]
+    for site, save_name in sites:
+        save_dir = os.path.join("stack-exchange", save_name)
+        out.append(Task(save_name, "fetch_stack_exchange:get_and_format",
+            args=(f"https://archive.org/download/stackexchange/{site}.7z", save_dir),
+            outputs=[os.path.join(save_dir, x) for x in ("train.jsonl.gz", "val.jsonl.gz")],
+            kind="mem", group="stack-exchange"))
+
+    out.append(Task("wiki", "fetch_wiki:main",
+        outputs=["wiki/proofwiki_train.jsonl.gz", "wiki/proofwiki_val.jsonl.gz",
+            "wiki/wikipedia_train.jsonl.gz", "wiki/wikipedia_val.jsonl.gz"],
+        group="wiki"))
+
+    out.append(Task("arxiv-fetch", "fetch_arxiv:main", outputs=["arxiv_manifest.xml"],
+        kind="cpu", group="arxiv"))
+    out.append(Task("arxiv", "fetch_arxiv:archive_months", inputs=["arxiv_manifest.xml"],
+        outputs=["arxiv/archives.txt"], kind="cpu", group="arxiv"))
+
+    reference = [x for t in out if t.group in ("books", "formal") for x in t.outputs]
+    out.append(Task("noise-model", "noise_filter:train", inputs=reference,
+        outputs=["noise_model.npz"], kind="cpu", group="noise"))
+
+    # records which files the books and formal shards hold, and the arxiv months
+    out.append(Task("splits", "gen_split:main", inputs=reference + ["arxiv/archives.txt"],
+        outputs=["splits.json", "splits.idx"], kind="cpu", group="splits"))
+    return out
+
+
+def _dependencies(all_tasks):
+    producers = {x: t.name for t in all_tasks for x in t.outputs}
+    return {
+        t.name: set(t.deps) | {producers[x] for x in t.inputs if x in producers}
+        for t in all_tasks
+    }
+
+
+def _selected(all_tasks, deps, targets):
+    """
+    `targets` and everything they depend on.
+    """
+    if not targets:
+        return {t.name for t in all_tasks}
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in selected:
+            selected.add(name)
+            stack.extend(deps[name])
+    return selected
+
+
+def _critical_path(times, deps):
+    """
+    The chain of tasks that determined the end-to-end wall time: starting from
+    the task that finished last, repeatedly step to the dependency that
+    finished last.
+    """
+    if not times:
+        return []
+    name = max(times, key=lambda x: times[x][1])
+    path = [name]
+    while True:
+        ran = [d for d in deps[name] if d in times]
+        if not ran:
+            break
+        name = max(ran, key=lambda x: times[x][1])
+        path.append(name)
+    return path[::-1]
+
+
+def report(times, deps, failed, t0, width=40):
+    if not times:
+        return
+    end = max(x[1] for x in times.values())
+    total = max(end - t0, 1e-9)
+    critical = set(_critical_path(times, deps))
+    print("\nTIMELINE")
+    for name, (start, stop) in sorted(times.items(), key=lambda x: x[1][0]):
+        a = int(width * (start - t0) / total)
+        b = max(int(width * (stop - t0) / total), a + 1)
+        bar = " " * a + ("#" if name in critical else "=") * (b - a)
+        print(f"{name:>32} |{bar:<{width}}| {stop - start:9.1f}s")
+    print(f"critical path ({end - t0:.1f}s): " + " -> ".join(_critical_path(times, deps)))
+    print(f"sum of task times: {sum(b - a for a, b in times.values()):.1f}s")
+    if failed:
+        print("FAILED: " + ", ".join(sorted(failed)))
+
+
+def build(all_tasks, targets=(), io_workers=8, cpu_workers=None, mem_workers=2,
+        force=False, dry_run=False):
+    deps = _dependencies(all_tasks)
+    by_name = {t.name: t for t in all_tasks}
+    for name in targets:
+        if name not in by_name:
+            raise KeyError(f"unknown task {name}")
+    todo = _selected(all_tasks, deps, targets)
+
+    done, failed, times = set(), set(), {}
+    if not force:
+        # a task is only up to date if none of its dependencies will be rebuilt
+        stale = set()
+        changed = True
+        while changed:
+            changed = False
+            for name in todo - stale:
+                if deps[name] & stale or not by_name[name].up_to_date():
+                    stale.add(name)
+                    changed = True
+        for name in todo - stale:
+            print(f"up to date: {name}")
+            done.add(name)
+        todo = stale
+
+    if dry_run:
+        print("would run: " + ", ".join(sorted(todo)))
+        return True
+
+    # the start of the run for every worker's download cache, see cache.py
+    os.environ["PROOF_PILE_RUN_START"] = str(time.time())
+    cpu_workers = cpu_workers or min(4, os.cpu_count())
+    os.environ["PROOF_PILE_WORKERS"] = str(max(1, os.cpu_count() // cpu_workers))
+    pools = {
+        "io": ProcessPoolExecutor(io_workers, max_tasks_per_child=1),
+        "cpu": ProcessPoolExecutor(cpu_workers, max_tasks_per_child=1),
+        "mem": ProcessPoolExecutor(mem_workers, max_tasks_per_child=1),
+    }
+    running = {}
+    t0 = time.time()
+    try:
+        while todo or running:
+            for name in sorted(todo):
+                if deps[name] & failed:
+                    print(f"skipping {name}, a dependency failed")
+                    failed.add(name)
+                    todo.remove(name)
+                elif deps[name] <= done:
+                    task = by_name[name]
+                    print(f"starting {name}")
+                    running[pools[task.kind].submit(_run, task)] = name
+                    todo.remove(name)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    times[name] = future.result()
+                    done.add(name)
+                    print(f"finished {name} in {times[name][1] - times[name][0]:.1f}s")
+                except Exception as e:
+                    print(f"FAILED {name}: {e!r}")
+                    failed.add(name)
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+    report(times, deps, failed, t0)
+    metrics.print_summary(since=t0)
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the proof-pile.")
+    parser.add_argument("targets", nargs="*", help="tasks to build, defaults to all")
+    parser.add_argument("--io-workers", type=int, default=8)
+    parser.add_argument("--cpu-workers", type=int, default=None,
+            help="defaults to 4, each using a share of the CPUs")
+    parser.add_argument("--mem-workers", type=int, default=2,
+            help="memory-heavy tasks, e.g. Stack Exchange sites, run at once")
+    parser.add_argument("--force", action="store_true", help="rebuild up to date tasks")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--profile", metavar="STAGES", default=None,
+            help="comma separated stages to profile, or 'all', see profiler.py")
+    args = parser.parse_args()
+
+    if args.profile:
+        # read by the workers, which inherit the environment
+        os.environ["PROOF_PILE_PROFILE"] = args.profile
+
+    creds = ("zhangir-azerbayev", os.environ.get("GITHUB_TOKEN"))
+    ok = build(tasks(creds), args.targets, io_workers=args.io_workers,
+            cpu_workers=args.cpu_workers, mem_workers=args.mem_workers, force=args.force,
+            dry_run=args.dry_run)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
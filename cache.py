@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+CACHE_DIR = os.environ.get(
+    "PROOF_PILE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "proof-pile")
+)
+CACHE_MAX_BYTES = int(os.environ.get("PROOF_PILE_CACHE_BYTES", 100 * 2**30))
+# how long an artifact stored under a "url:" key, whose content can change, is served
+URL_TTL_SECONDS = float(os.environ.get("PROOF_PILE_CACHE_URL_TTL", 30 * 24 * 3600))
+# objects used since this time are never evicted. build.py sets it for its
+# workers, so that one worker does not evict what another is about to read
+RUN_START = float(os.environ.setdefault("PROOF_PILE_RUN_START", str(time.time())))
+
+
+def sha256_of_file(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    """
+    A local content-addressed store of raw downloads, shared by every fetcher.
+
+    Artifacts are looked up by a key naming something immutable: a commit sha,
+    a blob sha, an LFS oid, or the url itself for unpinned sources. The key maps
+    to the sha256 of the content, which is the artifact's file name under
+    `objects/` and is checked again on every read. Artifacts under "url:" keys
+    are downloaded again once they are older than `url_ttl` seconds.
+
+    Least recently read artifacts are evicted once the store grows past
+    `max_bytes`, by one process at a time, and never those read or written
+    since `run_start`, as another process of the same build may still use them.
+    """
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, url_ttl=URL_TTL_SECONDS,
+            run_start=RUN_START):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.url_ttl = url_ttl
+        self.run_start = run_start
+        self._objects = os.path.join(root, "objects")
+        self._keys = os.path.join(root, "keys")
+        self._tmp = os.path.join(root, "tmp")
+        for d in (self._objects, self._keys, self._tmp):
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total = None
+
+    def _key_path(self, key):
+        return os.path.join(self._keys, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def path(self, key):
+        """
+        Local path of the artifact stored under `key`, or None on a miss.
+        Corrupted artifacts are dropped and reported as misses.
+        """
+        key_path = self._key_path(key)
+        try:
+            with open(key_path) as f:
+                digest = json.load(f)["sha256"]
+            if key.startswith("url:") and time.time() - os.path.getmtime(key_path) > self.url_ttl:
+                return None
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        object_path = self._object_path(digest)
+        try:
+            # the mtime of an object is its last use, for LRU eviction, and
+            # from here on `evict` leaves it alone
+            os.utime(object_path)
+        except FileNotFoundError:
+            return None
+        if sha256_of_file(object_path) != digest:
+            print(f"cache: {key} failed its integrity check, dropping it")
+            os.remove(object_path)
+            return None
+        return object_path
+
+    def get(self, key):
+        path = self.path(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def tempfile(self):
+        """
+        A fresh path on the cache's filesystem, to be filled in and then `put_file`'d.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp)
+        os.close(fd)
+        return tmp_path
+
+    def put_file(self, key, src_path, sha256=None):
+        """
+        Moves `src_path` into the store under `key`. If `sha256` is known ahead
+        of time, e.g. an LFS oid, the content is checked against it.
+        """
+        digest = sha256_of_file(src_path)
+        if sha256 is not None and digest != sha256:
+            os.remove(src_path)
+            raise AssertionError(f"{key}: expected sha256 {sha256}, got {digest}")
+
+        object_path = self._object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        size = os.path.getsize(src_path)
+        existed = os.path.exists(object_path)
+        os.replace(src_path, object_path)
+
+        key_path = self._key_path(key)
+        with open(key_path + ".tmp", "w") as f:
+            json.dump({"key": key, "sha256": digest}, f)
+        os.replace(key_path + ".tmp", key_path)
+
+        with self._lock:
+            if self._total is not None and not existed:
+                self._total += size
+        if self._total is None or self._total > self.max_bytes:
+            self.evict(keep=object_path)
+        return object_path
+
+    def put(self, key, data, sha256=None):
+        tmp_path = self.tempfile()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self.put_file(key, tmp_path, sha256=sha256)
+
+    def fetch_file(self, key, download, sha256=None):
+        """
+        Path of the artifact under `key`. On a miss, `download(dest_path)` is
+        called to write it first.
+        """
+        path = self.path(key)
+        if path is None:
+            # named after the key, so a resumable download finds its partial
+            # file again on the next run
+            tmp_path = os.path.join(self._tmp, os.path.basename(self._key_path(key)))
+            download(tmp_path)
+            path = self.put_file(key, tmp_path, sha256=sha256)
+        return path
+
+    def fetch(self, key, fetch, sha256=None):
+        """
+        Like `fetch_file`, for small artifacts. `fetch()` returns the bytes.
+        """
+        data = self.get(key)
+        if data is None:
+            data = fetch()
+            self.put(key, data, sha256=sha256)
+        return data
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        Holds the cache's lock file, shared by every process using the cache.
+        """
+        with self._lock, open(os.path.join(self.root, "lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self, keep=None):
+        with self._exclusive():
+            entries = []
+            total = 0
+            for d in os.scandir(self._objects):
+                for entry in os.scandir(d.path):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes or mtime >= self.run_start:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    # read by another process since the scan
+                    if os.stat(path).st_mtime >= self.run_start:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._total = total
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ArtifactCache()
+    return _default_cache
+
+
+def cached_download(url, key=None, sha256=None):
+    """
+    Path of the local copy of `url`, downloading it on a cache miss. `key`
+    defaults to the url itself, which is right for unpinned sources.
+    """
+    from download import download
+
+    return default_cache().fetch_file(
+        key or "url:" + url, lambda dest_path: download(url, dest_path, sha256=sha256)
+    )
@@ -0,0 +1,82 @@
+import os
+import time
+
+import requests
+from tqdm import tqdm
+
+from cache import sha256_of_file
+
+
+def download(url, dest_path, sha256=None, chunk_size=1 << 22, retries=5, session=None):
+    """
+    Streams `url` to disk and returns `dest_path`. Nothing is held in memory
+    beyond one chunk.
+
+    Data goes to `dest_path + ".part"` first. If the connection drops, the
+    download resumes from where it stopped with an HTTP Range request, also
+    across separate runs. If `sha256` is given, e.g. an LFS oid, the finished
+    file is checked against it before being moved into place.
+
+    Content-Length and Range count the bytes on the wire, so the download asks
+    for no content encoding. A server that encodes anyway is not resumed: its
+    part file holds decoded bytes, so a failed attempt starts over.
+    """
+    get = (session or requests).get
+    part_path = dest_path + ".part"
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        encoded = False
+        try:
+            with get(url, stream=True, headers=headers, timeout=60) as resp:
+                if resp.status_code == 416:
+                    # the part file may already hold everything, "bytes */<total>"
+                    total = resp.headers.get("content-range", "").rpartition("/")[2]
+                    if total.isdigit() and int(total) == offset:
+                        break
+                    if not total.isdigit() and sha256 is not None:
+                        # checked against the hash below
+                        break
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise IOError(f"{url}: range from {offset} not satisfiable, "
+                            f"total {total or 'unknown'}, starting over")
+                if resp.status_code == 200:
+                    # the server ignored the Range header, start over
+                    offset = 0
+                elif resp.status_code != 206:
+                    raise AssertionError(f"Failed to download {url} ({resp.status_code})")
+
+                encoded = resp.headers.get("content-encoding", "identity") != "identity"
+                length = int(resp.headers.get("content-length", 0))
+                total = offset + length if length and not encoded else None
+                with open(part_path, "ab" if offset else "wb") as f, tqdm(
+                    total=total, initial=offset, unit="iB", unit_scale=True
+                ) as progress_bar:
+                    for data in resp.iter_content(chunk_size):
+                        f.write(data)
+                        progress_bar.update(len(data))
+
+                if total is not None and os.path.getsize(part_path) != total:
+                    raise IOError(f"Incomplete download of {url}")
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError, IOError):
+            if encoded and os.path.exists(part_path):
+                os.remove(part_path)
+            if attempt == retries:
+                raise
+            time.sleep(2**attempt)
+
+    if sha256 is not None:
+        digest = sha256_of_file(part_path)
+        if digest != sha256:
+            os.remove(part_path)
+            raise AssertionError(f"{url}: expected sha256 {sha256}, got {digest}")
+
+    os.replace(part_path, dest_path)
+    return dest_path
+
@@ -1,8 +1,3 @@
 #!/bin/sh
-python fetch_books_and_formal.py
-python fetch_math_dataset.py
-python fetch_stack_exchange.py
-python fetch_wiki.py
-python fetch_arxiv.py
-
-python gen_split.py
+# runs every fetch script and then gen_split.py, see build.py
+python build.py "$@"
@@ -13,63 +13,18 @@ import time
 
 import shutil
 
-import arxiv 
+from metrics import count, reject, stage
+from profiler import profile
+from utils import make_archive, prune_tree, task_workers
 
-import langdetect
-from langdetect import detect
+# kept after the fetch, as the record of which shards it covered
+MANIFEST_PATH = "arxiv_manifest.xml"
+# the month archives, written once every month is archived
+ARCHIVES_PATH = os.path.join("arxiv", "archives.txt")
 
-from utils import Loader as Loader
-from utils import make_archive
-
-def batch_loader(seq, size):
-    """
-    Iterator that takes in a list `seq` and returns
-    chunks of size `size` 
-    """
-    return [seq[pos:pos + size] for pos in range(0, len(seq), size)]
-
-
-def _delete_files_except_pattern(path, pattern, transform = lambda x: None, verbose=False):
-    """
-    recursively
-    """
-    for f in os.listdir(path):
-        f_path = os.path.join(path, f)
-        if verbose: 
-            print(f_path)
-        if os.path.isfile(f_path): 
-            if not re.search(pattern, f):
-                os.chmod(f_path, 0o755)
-                os.remove(f_path)
-            else: 
-                transform(f_path)
-        elif os.path.isdir(f_path):
-            try: 
-                print(f_path)
-            except UnicodeEncodeError: 
-                new_path = f_path.encode("utf-8", 'replace').decode()
-                os.system(f"mv \"{f_path}\" \"{new_path}\"")
-                f_path = new_path
-
-            _delete_files_except_pattern(f_path, pattern, transform=transform, verbose=verbose)
-
-def _download_with_progress_bar(url):
-    response = requests.get(url, stream=True)
-    total_size_in_bytes = int(response.headers.get("content-length", 0))
-    block_size = 1024  # 1 Kibibyte
-    progress_bar = tqdm(total=total_size_in_bytes, unit="iB", unit_scale=True)
-    to_return = bytearray()
-    for data in response.iter_content(block_size):
-        progress_bar.update(len(data))
-        to_return += data
-    progress_bar.close()
-    if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-        raise AssertionError("ERROR, something went wrong")
-
-    return to_return
 
 def get_math_ids(resumption_token="init"): 
-    with Loader(f"fetching metadata shard {resumption_token}..."):
+    with stage("metadata", resumption_token=resumption_token):
         if resumption_token=="init": 
             resp = requests.get("https://export.arxiv.org/oai2?verb=ListIdentifiers&set=math&metadataPrefix=oai_dc")
         else: 
@@ -90,6 +45,7 @@ def get_math_ids(resumption_token="init"):
         db_id = article[0].text
         eyed = db_id[db_id.rindex(":")+1:]
         math_ids[eyed] = True 
+        count("math_ids")
 
 def clean_tex_file(path): 
     with open(path, encoding="utf-8") as f: 
@@ -115,7 +71,10 @@ def clean_tex_file(path):
                     except (UnicodeDecodeError, UnicodeError): 
                         print(f"Decoding error at {path} with all of utf-8, 16, 32 and latin-1. Deleting this file")
                         print("This issue should only occur with a handful of quite old files. Continuing...\n")
+                        reject("decode_failure")
                         return 
+    count("docs_in")
+    count("bytes_read", len(src))
 
     end = re.search(r"\\end\{document\}", src)
     if end: 
@@ -128,10 +87,17 @@ def clean_tex_file(path):
     os.chmod(path, 0o755)
     with open(path, "w", encoding="utf-8") as f: 
         f.write(src)
+    count("docs_out")
+    count("bytes_written", len(src))
 
 def clean_tex_file_some_more(path): 
+    # imported here, loading its language profiles is slow
+    from langdetect import detect, LangDetectException
+
     with open(path) as f:
         text = f.read()
+    count("docs_in")
+    count("bytes_read", len(text))
 
     text = re.sub(r"(?<!\\)%.*", "", text) # deletes comments
 
@@ -154,16 +120,23 @@ def clean_tex_file_some_more(path):
 
         try: 
             lang = detect(text)
-        except langdetect.lang_detect_exception.LangDetectException: 
+        except LangDetectException: 
             # no linguistic features to analyze, delete
+            reject("no_language_features")
             return 
         
         if lang=="en": 
             with open(path, "w") as f: 
                 f.write(text)
+            count("docs_out")
+            count("bytes_written", len(text))
         else: 
             print("HIT NONENGLISH ARTICLE")
+            reject("non_english")
+    else: 
+        reject("too_short")
 
+@profile("process_tarball")
 def process_tarball_old_scheme(tarball_name, save_dir): 
     tarball_path = os.path.join(save_dir, tarball_name)
     os.system("tar -xf " + tarball_path + " -C " + save_dir)
@@ -192,9 +165,11 @@ def process_tarball_old_scheme(tarball_name, save_dir):
             else: 
                 os.remove(zipped_path)
 
-    _delete_files_except_pattern(subpath, r".*\.tex", transform=clean_tex_file)
+    prune_tree(subpath, r".*\.tex", transform=clean_tex_file,
+            workers=task_workers(), processes=True)
     os.remove(tarball_path)
 
+@profile()
 def process_tarball(tarball_name, save_dir, math_ids): 
     tarball_path = os.path.join(save_dir, tarball_name)
     untar_cmd = "tar -xf " + tarball_path + " -C " + save_dir
@@ -223,7 +198,8 @@ def process_tarball(tarball_name, save_dir, math_ids):
                 unzipped_path = os.path.join(subpath, eyed)
                 os.rename(unzipped_path, unzipped_path + ".tex")
     
-    _delete_files_except_pattern(subpath, r".*\.tex", transform=clean_tex_file)
+    prune_tree(subpath, r".*\.tex", transform=clean_tex_file,
+            workers=task_workers(), processes=True)
     os.remove(tarball_path)
 
 def main(): 
@@ -234,7 +210,7 @@ def main():
 
     save_dir = "arxiv"
     Path(save_dir).mkdir(exist_ok=True) 
-    manifest_path = os.path.join(save_dir, "manifest.xml")
+    manifest_path = MANIFEST_PATH + ".tmp"
     
     os.system(f"s3cmd get s3://arxiv/src/arXiv_src_manifest.xml --requester-pays {manifest_path}") 
 
@@ -258,15 +234,29 @@ def main():
         # nb this code will stop working in 2051 ;) 
         year = int("19" + yymm[:2]) if int(yymm[:2])>50 else int("20"+yymm[:2])
         if datetime.datetime(year, int(yymm[2:]), 1)<=format_cutoff: 
-            process_tarball_old_scheme(tarball_name, save_dir)
+            with stage("tarball", shard=shard):
+                process_tarball_old_scheme(tarball_name, save_dir)
         else: 
-            process_tarball(tarball_name, save_dir, math_ids) 
+            with stage("tarball", shard=shard):
+                process_tarball(tarball_name, save_dir, math_ids) 
+
+    os.replace(manifest_path, MANIFEST_PATH)
+
+def archive_months(): 
+    # only the month directories, archives of an earlier run are left alone
+    months = sorted(f for f in os.listdir("arxiv") if os.path.isdir(os.path.join("arxiv", f)))
+    with stage("clean"):
+        for f in months:
+            prune_tree(os.path.join("arxiv", f), r".*\.tex$", transform=clean_tex_file_some_more,
+                    workers=task_workers(), processes=True)
+    for f in tqdm(months):
+        f_path = os.path.join("arxiv", f)
+        with stage("archive", month=f):
+            make_archive(f_path)
 
-    os.remove(manifest_path)
+    with open(ARCHIVES_PATH, "w") as f:
+        f.write("".join(x + "\n" for x in sorted(os.listdir("arxiv")) if ".tar." in x))
 
 if __name__=="__main__": 
     main()
-    _delete_files_except_pattern("arxiv", r".*\.tex$", transform=clean_tex_file_some_more)
-    for f in tqdm(os.listdir("arxiv")):
-        f_path = os.path.join("arxiv", f)
-        make_archive(f_path)
+    archive_months()
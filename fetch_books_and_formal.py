@@ -1,139 +1,232 @@
+import io
 import sys
 import os
+import shutil
 
 import json
-import ndjson
 import re
+import itertools
 
 from pathlib import Path
 from tqdm import tqdm
 
 import requests
-from tqdm import tqdm
+import tarfile
 
-import base64
+from github_api import GithubFetcher
+from cache import cached_download, default_cache
+from download import download
+from gen_split import load_split_lookup
+from metrics import count, reject, stage
+from profiler import profile
+from utils import JsonlShardWriter, prune_tree, remove_tree, walk_files
 
+@profile()
 def jsonl_of_path(path, jsonl_train_path, jsonl_val_path, 
         train_split_key, val_split_key): 
-    train_instances = []
-    val_instances = []
     print("CREATING JSONL.GZ")
-    with open("splits.json") as f: 
-        splits = json.load(f)
-
-    for root, dirs, files in tqdm(os.walk(path)): 
-        for name in files: 
-            this_path = os.path.join(root, name)
-            with open(this_path) as f: 
-                text = f.read()
-
-            instance = {"text": text, 
-                        "meta": {
-                            "subset_name": "curated", 
-                            "file": os.path.join(root, name)
-                       }
-            }
-
-            if this_path in splits[train_split_key]: 
-                train_instances.append(instance)
-            elif this_path in splits[val_split_key]: 
-                val_instances.append(instance)
-            else: 
-                raise KeyError("key not found in splits.json")
-
-
-    with open(jsonl_train_path, "w") as f: 
-        ndjson.dump(train_instances, f)
-    os.system("gzip " + jsonl_train_path)
-
-    with open(jsonl_val_path, "w") as f: 
-        ndjson.dump(val_instances, f)
-    os.system("gzip " + jsonl_val_path)
-
-    os.system("rm -r " + path)
+    with stage("jsonl", path=path), JsonlSplitSink(jsonl_train_path, jsonl_val_path,
+            train_split_key, val_split_key) as sink:
+        for root, dirs, files in tqdm(os.walk(path)): 
+            for name in files: 
+                this_path = os.path.join(root, name)
+                count("docs_in")
+                count("bytes_read", os.path.getsize(this_path))
+                with open(this_path) as f: 
+                    sink.write_lines(this_path, f)
+
+    remove_tree(path)
     print("succesful conversion to jsonl")
 
 
 def check_encoding(path): 
-    for f in os.listdir(path): 
-        f_path = os.path.join(path, f)
-        if os.path.isfile(f_path): 
-            with open(f_path, encoding="utf-8") as fle: 
-                try: 
-                    fle.read()
-                except UnicodeDecodeError: 
-                    print(f"{f_path} is not unicode")
-        elif os.path.isdir(f_path): 
-            check_encoding(f_path)
-
-
-def _get_dir_from_repo(author, repo, sha, repo_dir, save_path, creds):
+    for entry in walk_files(path): 
+        with open(entry.path, encoding="utf-8") as fle: 
+            try: 
+                fle.read()
+            except UnicodeDecodeError: 
+                print(f"{entry.path} is not unicode")
+                reject("decode_failure")
+
+
+# Files longer than this are split into several documents, see `chunks_of_lines`.
+MAX_CHUNK_CHARS = 200_000
+
+# Lines at which a file can be split without cutting a declaration or section
+# in half. Everything else is split at blank lines. Declarations may be
+# indented, e.g. inside a namespace, and preceded by modifiers.
+_CHUNK_BOUNDARIES = {
+    # comments, which hold set.mm's section headers and introduce its theorems
+    ".mm": r"\s*\$\(",
+    ".lean": r"\s*((private|protected|noncomputable|meta|partial|unsafe)\s+)*"
+        r"((theorem|lemma|def|abbreviation|abbrev|instance|structure|class|inductive"
+        r"|namespace|section)\b|@\[|/--)",
+    ".v": r"\s*((Local|Global|Program|Polymorphic)\s+)*"
+        r"((Theorem|Lemma|Definition|Fixpoint|Inductive|Record|Section|Module"
+        r"|Proposition|Corollary|Fact|Remark|Variable|Hypothesis|Instance)\b|\(\*\*)",
+    ".thy": r"\s*((private|qualified)\s+)*"
+        r"(theorem|lemma|definition|fun|function|primrec|datatype|locale|context"
+        r"|section|subsection|text|corollary|proposition|inductive|record|instantiation"
+        r"|class|type_synonym|abbreviation)\b",
+    # top-level only, an indented `let` is a local binding
+    ".ml": r"let\b",
+    ".miz": r"\s*(theorem|definition|registration|scheme|begin)\b",
+    ".tex": r"\s*\\(part|chapter|section|subsection)\*?\{",
+}
+
+
+def chunks_of_lines(lines, path, max_chars=MAX_CHUNK_CHARS):
     """
-    This super unelegant solution is to get around the github api rate limit
+    Splits a file, given as an iterable of lines, into documents of about
+    `max_chars` characters. Once a chunk has reached `max_chars` it ends at the
+    next top-level boundary for the file's format (see `_CHUNK_BOUNDARIES`),
+    and chunks without any boundary are cut at twice `max_chars`.
 
-    repo_dir must be top-level in the repo.
+    Yields `(text, first_line, last_line)`, with 1-based inclusive line numbers.
+    Only one chunk is held in memory at a time.
     """
-    Path(save_path).mkdir(parents=True, exist_ok=True)
-    archive_path = os.path.join(save_path, "archive.tar.gz")
-    tarball_url = (
-        "https://github.com/" + author + "/" + repo + "/archive/" + sha + ".tar.gz"
-    )
-
-    os.system("wget -O " + archive_path + " " + tarball_url)
-    os.system("tar -xzf " + archive_path + " -C " + save_path)
+    ext = os.path.splitext(path)[1].lower()
+    boundary = re.compile(_CHUNK_BOUNDARIES.get(ext, r"\s*$"))
+
+    chunk = []
+    size = 0
+    start = 1
+    for i, line in enumerate(lines, start=1):
+        if size >= 2 * max_chars or (size >= max_chars and boundary.match(line)):
+            yield "".join(chunk), start, i - 1
+            chunk = []
+            size = 0
+            start = i
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield "".join(chunk), start, start + len(chunk) - 1
+
+
+class JsonlSplitSink:
+    """
+    Writes curated documents to the train or val .jsonl.gz shard, by looking
+    up their path in the split index, as soon as they are produced. Nothing is
+    buffered beyond the writers' blocks.
+    """
+    def __init__(self, jsonl_train_path, jsonl_val_path,
+            train_split_key, val_split_key):
+        self.splits = load_split_lookup()
+        self.train_split_key = train_split_key
+        self.val_split_key = val_split_key
+        self.train = JsonlShardWriter(jsonl_train_path + ".gz")
+        self.val = JsonlShardWriter(jsonl_val_path + ".gz")
+
+    def write(self, path, text, **meta):
+        instance = {"text": text,
+                    "meta": {
+                        "subset_name": "curated",
+                        "file": path,
+                        **meta,
+                   }
+        }
+
+        split = self.splits.split_of(path, (self.train_split_key, self.val_split_key))
+        if split == self.train_split_key:
+            self.train.write(instance)
+        else:
+            self.val.write(instance)
+
+    def write_lines(self, path, lines):
+        """
+        Writes a file given as an iterable of lines, split into bounded-size
+        chunks. Chunks record which part of `path` they came from.
+        """
+        chunks = chunks_of_lines(lines, path)
+        first = next(chunks, None)
+        if first is None:
+            self.write(path, "")
+            return
+        second = next(chunks, None)
+        if second is None:
+            self.write(path, first[0])
+            return
+
+        for i, (text, first_line, last_line) in enumerate(
+                itertools.chain([first, second], chunks)):
+            self.write(path, text, chunk=i, lines=[first_line, last_line])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for writer in (self.train, self.val):
+            if exc_type is None:
+                writer.close()
+            else:
+                writer.abort()
+
+
+class _StreamMember(io.RawIOBase):
+    """
+    A member of a tarball opened in stream mode, whose file object raises on
+    `seekable()` and so cannot be wrapped in an `io.TextIOWrapper` directly.
+    """
+    def __init__(self, f):
+        self._f = f
 
-    export_name = repo + "-" + sha
+    def readable(self):
+        return True
 
-    os.system(
-        "cp -r " + os.path.join(save_path, export_name, repo_dir, "*") + " " + save_path
-    )
-    os.system("rm -r " + os.path.join(save_path, export_name) + " " + archive_path)
+    def readinto(self, b):
+        data = self._f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
 
 
-def _delete_files_except_pattern(path, pattern):
+def _iter_tarball(source, prefix, pattern, exclude=()):
     """
-    recursively
+    Streams the .tar.gz at `source` (a url or a local path) and yields
+    `(path, file)` for every regular file below the top-level `prefix` whose
+    name matches `pattern`, `file` being a text stream with universal newlines.
+    Paths are relative to `prefix`, and nothing is extracted to disk or read
+    whole into memory. Each file must be consumed before the next is yielded.
     """
-    for f in os.listdir(path):
-        f_path = os.path.join(path, f)
-        if os.path.isfile(f_path):
-            if not re.search(pattern, f):
-                os.remove(f_path)
-            else: # debugging
-                with open(f_path, encoding="utf-8") as f: 
-                    try: 
-                        f.read()
-                    except: 
-                        print(f"{f_path} not unicode encoded")
-        elif os.path.islink(f_path): 
-            os.remove(f_path)
-        elif os.path.isdir(f_path):
-            _delete_files_except_pattern(f_path, pattern)
-
-
-def _download_with_progress_bar(url):
-    response = requests.get(url, stream=True)
-    total_size_in_bytes = int(response.headers.get("content-length", 0))
-    block_size = 1024  # 1 Kibibyte
-    progress_bar = tqdm(total=total_size_in_bytes, unit="iB", unit_scale=True)
-    to_return = bytearray()
-    for data in response.iter_content(block_size):
-        progress_bar.update(len(data))
-        to_return += data
-    progress_bar.close()
-    if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-        raise AssertionError("ERROR, something went wrong")
-
-    return to_return
-
-
-def _blob_to_text(blob, creds):
-    resp = requests.get(blob["url"], auth=creds)
-    if resp.status_code != 200:
-        raise AssertionError("Failed to fetch from Github API")
-
-    resp_json = json.loads(resp.content.decode("utf-8"))
-    return base64.b64decode(resp_json["content"])
+    if os.path.exists(source):
+        fileobj = open(source, "rb")
+    else:
+        resp = requests.get(source, stream=True)
+        if resp.status_code != 200:
+            raise AssertionError(f"Failed to fetch {source}")
+        fileobj = resp.raw
+
+    with fileobj, tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # the tarball's root directory is "<repo>-<sha>"
+            name = member.name.split("/", 1)[-1]
+            if not name.startswith(prefix):
+                continue
+            rel = name[len(prefix):]
+            if any(rel.startswith(x) for x in exclude):
+                continue
+            if not re.search(pattern, os.path.basename(rel)):
+                continue
+            count("docs_in")
+            count("bytes_read", member.size)
+            yield rel, io.TextIOWrapper(io.BufferedReader(_StreamMember(tar.extractfile(member))),
+                    encoding="utf-8")
+
+
+def _jsonl_of_tarball(sink, source, prefix, pattern, save_path, exclude=()):
+    for rel, f in tqdm(_iter_tarball(source, prefix, pattern, exclude)):
+        sink.write_lines(os.path.join(save_path, rel), f)
+
+
+def _github_tarball(author, repo, sha):
+    """
+    Local path of the tarball of `repo` at commit `sha`, served from the cache when we have it.
+    """
+    return cached_download(
+        "https://github.com/" + author + "/" + repo + "/archive/" + sha + ".tar.gz",
+        key=f"github-tarball:{author}/{repo}@{sha}",
+    )
 
 
 def lean(creds):
@@ -185,18 +278,20 @@ def lean(creds):
         },
     ]
 
-    for source in sources:
-        _get_dir_from_repo(**source, creds=creds)
-        _delete_files_except_pattern(source["save_path"], r".*\.lean")
-
     # we also don't want meta code
-    to_delete = ["tactic", "meta"]
-    os.system(
-        "rm -r " + " ".join([os.path.join(save_dir, "mathlib", x) for x in to_delete])
-    )
+    exclude = {"mathlib": ["tactic/", "meta/"]}
 
-    jsonl_of_path(save_dir, "formal/lean_train.jsonl", "formal/lean_val.jsonl", 
-            "formal-train", "formal-valid")
+    with JsonlSplitSink("formal/lean_train.jsonl", "formal/lean_val.jsonl",
+            "formal-train", "formal-valid") as sink:
+        for source in sources:
+            _jsonl_of_tarball(
+                sink,
+                _github_tarball(source["author"], source["repo"], source["sha"]),
+                source["repo_dir"] + "/",
+                r".*\.lean",
+                source["save_path"],
+                exclude=exclude.get(source["repo"], ()),
+            )
 
 
 def coq(creds):
@@ -234,29 +329,30 @@ def coq(creds):
         },
     ]
 
-    for source in sources:
-        _get_dir_from_repo(**source, creds=creds)
-        _delete_files_except_pattern(source["save_path"], r".*\.v")
-
-    jsonl_of_path(save_dir, "formal/coq_train.jsonl", "formal/coq_val.jsonl", 
-            "formal-train", "formal-valid")
+    with JsonlSplitSink("formal/coq_train.jsonl", "formal/coq_val.jsonl",
+            "formal-train", "formal-valid") as sink:
+        for source in sources:
+            _jsonl_of_tarball(
+                sink,
+                _github_tarball(source["author"], source["repo"], source["sha"]),
+                source["repo_dir"] + "/",
+                r".*\.v",
+                source["save_path"],
+            )
 
 
 def trench():
     save_dir = "books/trench"
-    archive_path = os.path.join(save_dir, "trench.zip")
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
     print("DOWNLOADING TRENCH")
-    os.system(
-        "wget -O "
-        + archive_path
-        + ' "https://digitalcommons.trinity.edu/cgi/viewcontent.cgi?filename=2&article=1006&context=mono&type=additional"'
+    archive_path = cached_download(
+        "https://digitalcommons.trinity.edu/cgi/viewcontent.cgi?filename=2&article=1006&context=mono&type=additional"
     )
     print("DONE DOWNLOADING TRENCH")
 
     os.system("unzip " + archive_path + " -d " + save_dir)
-    to_delete = ["trench.zip", "wtrench.sty", "SETEPS.TEX", "EPS"]
+    to_delete = ["wtrench.sty", "SETEPS.TEX", "EPS"]
     os.system("rm -r " + " ".join([os.path.join(save_dir, f) for f in to_delete]))
 
     jsonl_of_path(save_dir, "books/trench_train.jsonl", "books/trench_val.jsonl", 
@@ -265,43 +361,50 @@ def trench():
 
 def setmm(creds):
     save_dir = "formal/setmm"
-    Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    headers = {
-        "Accept": "application/vnd.git-lfs+json",
-    }
-
-    json_data = {
-        "operation": "download",
-        "transfer": [
-            "basic",
-        ],
-        "objects": [
-            {
-                "oid": "ff1a12d49d4c68a05245bfd369af358b93c51b8c141419085bb5cef830f6eb7a",
-                "size": 182269314,
-            },
-        ],
-    }
-
-    response = requests.post(
-        "https://github.com/zhangir-azerbayev/mm-extract.git/info/lfs/objects/batch",
-        headers=headers,
-        json=json_data,
-    )
+    oid = "ff1a12d49d4c68a05245bfd369af358b93c51b8c141419085bb5cef830f6eb7a"
+
+    def download_lfs_object(dest_path):
+        headers = {
+            "Accept": "application/vnd.git-lfs+json",
+        }
+
+        json_data = {
+            "operation": "download",
+            "transfer": [
+                "basic",
+            ],
+            "objects": [
+                {
+                    "oid": oid,
+                    "size": 182269314,
+                },
+            ],
+        }
+
+        response = requests.post(
+            "https://github.com/zhangir-azerbayev/mm-extract.git/info/lfs/objects/batch",
+            headers=headers,
+            json=json_data,
+        )
 
-    resp_json = response.json()
+        resp_json = response.json()
 
-    download_url = resp_json["objects"][0]["actions"]["download"]["href"]
+        download_url = resp_json["objects"][0]["actions"]["download"]["href"]
 
-    encoded_src = _download_with_progress_bar(download_url)
-    src = encoded_src.decode("utf-8")
+        download(download_url, dest_path, sha256=oid)
 
-    with open(os.path.join(save_dir, "set.mm"), "w") as f:
-        f.write(src)
+    # the LFS oid is the sha256 of set.mm, so the download can be checked against it
+    src_path = default_cache().fetch_file("lfs:" + oid, download_lfs_object)
 
-    jsonl_of_path(save_dir, "formal/setmm_train.jsonl", "formal/setmm_val.jsonl", 
-            "formal-train", "formal-valid")
+    # read straight from the cache, under the path it always had in the shards
+    print("CREATING JSONL.GZ")
+    with stage("jsonl", path=save_dir), JsonlSplitSink("formal/setmm_train.jsonl",
+            "formal/setmm_val.jsonl", "formal-train", "formal-valid") as sink, \
+            open(src_path, encoding="utf-8") as f:
+        count("docs_in")
+        count("bytes_read", os.path.getsize(src_path))
+        sink.write_lines(os.path.join(save_dir, "set.mm"), f)
 
 
 def stein(creds):
@@ -309,13 +412,12 @@ def stein(creds):
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
     print("DOWNLOADING STEIN")
-    resp = _download_with_progress_bar(
-        "https://api.github.com/repos/williamstein/ent/git/blobs/a70578277b1222c94dc395f7d5baaf9862afd166"
+    sha = "a70578277b1222c94dc395f7d5baaf9862afd166"
+    src_encoded = GithubFetcher(creds).blob(
+        {"sha": sha, "url": "/repos/williamstein/ent/git/blobs/" + sha}
     )
     print("DONE DOWNLOADING STEIN")
 
-    resp_json = json.loads(resp.decode("utf-8"))
-    src_encoded = base64.b64decode(resp_json["content"])
     src = src_encoded.decode("utf-8")
 
     with open(os.path.join(save_dir, "stein.tex"), "w") as f:
@@ -326,10 +428,9 @@ def stein(creds):
 
 def cam(): 
     save_dir = "books/cam"
-    archive_path = os.path.join(save_dir, "cam.tar.gz")
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    os.system("wget -O " + archive_path + " https://github.com/dalcde/cam-notes/archive/06b2239.tar.gz")
+    archive_path = _github_tarball("dalcde", "cam-notes", "06b2239")
 
     os.system ("tar -xf " + archive_path + " -C " + save_dir)
     export_name = "cam-notes-06b2239b006f14d833cca2434190ebbf9a304bc6/"
@@ -340,10 +441,9 @@ def cam():
             + save_dir
     )
     os.system("rm -r " + os.path.join(save_dir, export_name))
-    os.remove(archive_path)
     os.remove(os.path.join(save_dir, "header.tex"))
 
-    _delete_files_except_pattern(save_dir, r".*\.tex")
+    prune_tree(save_dir, r".*\.tex")
 
     jsonl_of_path(save_dir, "books/cam_train.jsonl", "books/cam_val.jsonl", 
             "books-train", "books-valid")
@@ -353,92 +453,48 @@ def hol(testing=False):
     archive_path = os.path.join(save_dir, "hol.zip")
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    if not testing:
-        os.system(
-            "wget -O "
-            + archive_path
-            + " https://github.com/jrh13/hol-light/archive/538c62f.tar.gz"
-        )
-
-    os.system("tar -xvf " + archive_path + " -C " + save_dir)
-    os.system(
-        "mv "
-        + os.path.join(
-            save_dir, "hol-light-538c62f7cdb0df146752c83f85fa672ae3906b03/* "
-        )
-        + save_dir
-    )
-    os.system(
-        "rm -r "
-        + os.path.join(save_dir, "hol-light-538c62f7cdb0df146752c83f85fa672ae3906b03")
-    )
-    os.system("rm " + archive_path)
-
-    # all top level files are metaprogramming, so delete them
-    for f in os.listdir(save_dir):
-        f_path = os.path.join(save_dir, f)
-        if os.path.isfile(f_path):
-            os.remove(f_path)
-
-    os.system("rm -r formal/hol/Proofrecording")
-
-    _delete_files_except_pattern(save_dir, r".*\.ml|.*\.doc")
-
-    jsonl_of_path(save_dir, "formal/hol_train.jsonl", "formal/hol_val.jsonl", 
-            "formal-train", "formal-valid")
+    # all top level files are metaprogramming, so skip them
+    with JsonlSplitSink("formal/hol_train.jsonl", "formal/hol_val.jsonl",
+            "formal-train", "formal-valid") as sink:
+        for rel, f in tqdm(_iter_tarball(
+                archive_path if testing else _github_tarball("jrh13", "hol-light", "538c62f"),
+                "",
+                r".*\.ml|.*\.doc",
+                exclude=["Proofrecording/"],
+            )):
+            if "/" in rel:
+                sink.write_lines(os.path.join(save_dir, rel), f)
 
 def afp(testing=False):
     save_dir = "formal/afp"
     archive_path = os.path.join(save_dir, "afp.zip")
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    if not testing:
-        os.system(
-            "wget -O "
-            + archive_path
-            + " https://github.com/isabelle-prover/mirror-afp-2021-1/archive/5a85b23.tar.gz"
-        )
-
-    os.system("tar -xf " + archive_path + " -C " + save_dir)
-    os.system(
-        "mv "
-        + os.path.join(
+    with JsonlSplitSink("formal/afp_train.jsonl", "formal/afp_val.jsonl",
+            "formal-train", "formal-valid") as sink:
+        _jsonl_of_tarball(
+            sink,
+            archive_path if testing else _github_tarball(
+                "isabelle-prover", "mirror-afp-2021-1", "5a85b23"
+            ),
+            "thys/",
+            r".*\.thy|.*\.tex",
             save_dir,
-            "mirror-afp-2021-1-5a85b23fb030c472d9a7b2d65a61e428f4eb8233/thys/* ",
         )
-        + save_dir
-    )
-    os.system(
-        "rm -r "
-        + os.path.join(
-            save_dir, "mirror-afp-2021-1-5a85b23fb030c472d9a7b2d65a61e428f4eb8233"
-        )
-    )
-    os.system("rm " + archive_path)
-
-    _delete_files_except_pattern(save_dir, r".*\.thy|.*\.tex")
-
-    jsonl_of_path(save_dir, "formal/afp_train.jsonl", "formal/afp_val.jsonl", 
-            "formal-train", "formal-valid")
 
 def mizar(creds):
     save_dir = "formal/mizar"
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        "https://api.github.com/repos/zhangir-azerbayev/mizar-mirror/git/trees/ce8e9735fd7a4d3488069c48da76bc622aec46ec"
+    fetcher = GithubFetcher(creds)
+    tree = fetcher.tree(
+        "zhangir-azerbayev", "mizar-mirror", "ce8e9735fd7a4d3488069c48da76bc622aec46ec"
     )
-    if resp.status_code != 200:
-        raise AssertionError("Failed to fetch mizar from Github API")
-
-    resp_json = resp.json()
-    tree = resp_json["tree"]
-
-    print("DOWNLOADING MIZAR")
-    for blob in tqdm(tree):
+    for blob in tree:
         assert blob["type"] == "blob"
 
-        src = _blob_to_text(blob, creds)
+    print("DOWNLOADING MIZAR")
+    for blob, src in tqdm(fetcher.blobs(tree), total=len(tree)):
         src = src.decode("utf-8")
         # mml files have licensing information from lines 2-12
         src = "\n".join(
@@ -458,15 +514,8 @@ def hott(creds):
     save_dir = "books/hott"
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        "https://api.github.com/repos/HoTT/book/git/trees/781565e93979f926001a353bf4ee1284ffa4fcb0",
-        auth=creds,
-    )
-    if resp.status_code != 200:
-        raise AssertionError("Failed to fetch HoTT book from Github API")
-
-    resp_json = resp.json()
-    tree = resp_json["tree"]
+    fetcher = GithubFetcher(creds)
+    tree = fetcher.tree("HoTT", "book", "781565e93979f926001a353bf4ee1284ffa4fcb0")
     blobs = [blob for blob in tree if blob["type"] == "blob"]
 
     banned = [
@@ -477,19 +526,21 @@ def hott(creds):
 
     banned_rgx = r"opt|cover|front|hott"
 
+    blobs = [
+        blob
+        for blob in blobs
+        if blob["path"][-4:] == ".tex"
+        and blob["path"] not in banned
+        and not re.match(banned_rgx, blob["path"])
+    ]
+
     print("DOWNLOADING HOTT BOOK")
-    for blob in tqdm(blobs):
-        if (
-            blob["path"][-4:] == ".tex"
-            and blob["path"] not in banned
-            and not re.match(banned_rgx, blob["path"])
-        ):
-            src_enc = _blob_to_text(blob, creds)
-            src = src_enc.decode("utf-8")
-
-            save_path = os.path.join(save_dir, blob["path"])
-            with open(save_path, "w") as f:
-                f.write(src)
+    for blob, src_enc in tqdm(fetcher.blobs(blobs), total=len(blobs)):
+        src = src_enc.decode("utf-8")
+
+        save_path = os.path.join(save_dir, blob["path"])
+        with open(save_path, "w") as f:
+            f.write(src)
 
     print("DONE DOWNLOADING HOTT BOOK")
 
@@ -500,23 +551,20 @@ def stacks(creds):
     save_dir = "books/stacks"
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        "https://api.github.com/repos/stacks/stacks-project/git/trees/0a847ff5e41b47795be075e130e7810173b35933",
-        auth=creds,
-    )
-    resp_json = json.loads(resp.content.decode("utf-8"))
+    fetcher = GithubFetcher(creds)
     # assumes everything we need is a top level file, which is true for this commit.
-    blobs = resp_json["tree"]
+    tree = fetcher.tree("stacks", "stacks-project", "0a847ff5e41b47795be075e130e7810173b35933")
+    blobs = [
+        blob
+        for blob in tree
+        if blob["type"] == "blob"
+        and blob["path"][-4:] == ".tex"
+        and blob["path"] != "fdl.tex"
+    ]
     print("DOWNLOADING STACKS")
-    for blob in tqdm(blobs):
-        if (
-            blob["type"] == "blob"
-            and blob["path"][-4:] == ".tex"
-            and blob["path"] != "fdl.tex"
-        ):
-            decoded_content = _blob_to_text(blob, creds)
-            with open(os.path.join(save_dir, blob["path"]), "wb") as f:
-                f.write(decoded_content)
+    for blob, decoded_content in tqdm(fetcher.blobs(blobs), total=len(blobs)):
+        with open(os.path.join(save_dir, blob["path"]), "wb") as f:
+            f.write(decoded_content)
     print("DONE DOWNLOADING STACKS")
 
     jsonl_of_path(save_dir, "books/stacks_train.jsonl", "books/stacks_val.jsonl", 
@@ -526,21 +574,18 @@ def cring(creds):
     save_dir = "books/cring"
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        "https://api.github.com/repos/aisejohan/cring/git/trees/2db2618ff70831002aeefbb16885ee42d5198db3",
-        auth=creds,
-    )
-    if resp.status_code != 200:
-        raise AssertionError("Failed to catch cring from Github API")
-
-    trees = json.loads(resp.content.decode("utf-8"))["tree"]
+    fetcher = GithubFetcher(creds)
+    trees = fetcher.tree("aisejohan", "cring", "2db2618ff70831002aeefbb16885ee42d5198db3")
+    blobs = [
+        blob
+        for blob in trees
+        if blob["type"] == "blob" and blob["path"] != "license.tex"
+    ]
 
     print("DOWNLOADING CRING")
-    for blob in tqdm(trees):
-        if blob["type"] == "blob" and blob["path"] != "license.tex":
-            decoded_content = _blob_to_text(blob, creds)
-            with open(os.path.join(save_dir, blob["path"]), "wb") as f:
-                f.write(decoded_content)
+    for blob, decoded_content in tqdm(fetcher.blobs(blobs), total=len(blobs)):
+        with open(os.path.join(save_dir, blob["path"]), "wb") as f:
+            f.write(decoded_content)
 
     print("DONE DOWNLOADING CRING")
 
@@ -552,28 +597,22 @@ def napkin(creds):
     save_dir = "books/napkin"
     Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        "https://api.github.com/repos/vEnhance/napkin/git/trees/4f56c2ef5d0faf132ee14c15d96fb0f134d58bf0",
-        auth=creds,
-    )
-
-    if resp.status_code != 200:
-        raise AssertionError("Failed to catch napkin tree from Github API")
-
-    trees = json.loads(resp.content.decode("utf-8"))["tree"]
+    fetcher = GithubFetcher(creds)
+    trees = fetcher.tree("vEnhance", "napkin", "4f56c2ef5d0faf132ee14c15d96fb0f134d58bf0")
 
     # We are assuming that we only want the files exactly two levels deep
+    blobs = []
+    for tree in trees:
+        if tree["type"] == "tree":
+            blobs += [
+                blob for blob in fetcher.subtree(tree)
+                if blob["type"] == "blob"
+            ]
 
     print("DOWNLOADING NAPKIN")
-    for tree in tqdm(trees):
-        if tree["type"] == "tree":
-            resp = requests.get(tree["url"], auth=creds)
-            blobs = json.loads(resp.content.decode("utf-8"))["tree"]
-            for blob in blobs:
-                if blob["type"] == "blob":
-                    decoded_content = _blob_to_text(blob, creds)
-                    with open(os.path.join(save_dir, blob["path"]), "wb") as f:
-                        f.write(decoded_content)
+    for blob, decoded_content in tqdm(fetcher.blobs(blobs), total=len(blobs)):
+        with open(os.path.join(save_dir, blob["path"]), "wb") as f:
+            f.write(decoded_content)
     print("DONE DOWNLOADING NAPKIN")
 
     jsonl_of_path(save_dir, "books/napkin_train.jsonl", "books/napkin_val.jsonl", 
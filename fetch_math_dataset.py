@@ -1,62 +1,104 @@
 import os
-import sys
 import json
-import ndjson
+import tarfile
+from multiprocessing import Pool
 from pathlib import Path
-from fetch_mathoverflow import batch_loader
 import random
 
-from utils import make_archive
+from cache import cached_download
+from metrics import count, stage
+from utils import JsonlShardWriter, task_workers
 
 ARCHIVE_URL = "https://people.eecs.berkeley.edu/~hendrycks/MATH.tar"
 SAVE_PATH = "math-dataset"
 
-random.seed(20)
+SEED = 20
 
-def main():  
+
+def format_problem(prob_json):
+    text = "{\\bf Problem.} " + prob_json["problem"] + "\n" +\
+           "{\\bf Level.} " + prob_json["level"] + "\n" +\
+           "{\\bf Type.} " + prob_json["type"] + "\n" +\
+           "{\\bf Solution.} " + prob_json["solution"]
+    return text.strip()
+
+
+def _iter_problem_batches(archive_path, batch_size):
+    """
+    Reads MATH/{train,test}/<category>/<n>.json straight out of the tar,
+    yielding lists of `(split, category, name, bytes)`.
+    """
+    batch = []
+    with tarfile.open(archive_path, mode="r|*") as tar:
+        for member in tar:
+            parts = member.name.split("/")
+            if not member.isfile() or len(parts) != 4 or not parts[3].endswith(".json"):
+                continue
+            _, split, category, name = parts
+            batch.append((split, category, name, tar.extractfile(member).read()))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _format_batch(batch):
+    return [
+        (split, category, name, format_problem(json.loads(data)))
+        for split, category, name, data in batch
+    ]
+
+
+def _problem_number(name):
+    """
+    Sort key of a problem file: numeric names in numeric order, then any others by name.
+    """
+    stem = name[:-len(".json")]
+    return (0, int(stem), "") if stem.isdigit() else (1, 0, stem)
+
+
+def main(workers=None, batch_size=256):
+    """
+    Writes math-dataset/{train,val}.jsonl.gz from the MATH train split, and
+    math-dataset/test.jsonl.gz from the MATH test split, which is never
+    trained on and is kept for contamination checks.
+    """
     VAL_RATE=5e-2
     Path(SAVE_PATH).mkdir(exist_ok=True)
 
-    archive_path = os.path.join(SAVE_PATH, "archive.tar")
-    os.system("wget -O " + archive_path + " " + ARCHIVE_URL)
-    os.system("tar -xf " + archive_path + " -C " + SAVE_PATH)
-    
-    cat_dir = os.path.join(SAVE_PATH, "MATH/train")
-
-    for cat_name in os.listdir(cat_dir): 
-        cat_path = os.path.join(cat_dir, cat_name)
-        if os.path.isdir(cat_path):
-            cat_texts = []
-            for f in os.listdir(cat_path): 
-                f_path = os.path.join(cat_path, f)
-
-                with open(f_path) as fle: 
-                    prob_json = json.load(fle)
-
-                text = "{\\bf Problem.} " + prob_json["problem"] + "\n" +\
-                       "{\\bf Level.} " + prob_json["level"] + "\n" +\
-                       "{\\bf Type.} " + prob_json["type"] + "\n" +\
-                       "{\\bf Solution.} " + prob_json["solution"]
-
-                cat_texts.append(text)
-
-        random.shuffle(cat_texts) 
-        instances = [{"text": x.strip(), "meta": {"set_name": "MATH"}} for x in cat_texts]
-        split = int(VAL_RATE*len(instances))
-        train = instances[split:]
-        val = instances[:split]
-
-        with open(os.path.join(SAVE_PATH, "train.jsonl"), "a+") as f: 
-            f.write(ndjson.dumps(train))
-            f.write("\n")
-        with open(os.path.join(SAVE_PATH, "val.jsonl"), "a+") as f: 
-            f.write(ndjson.dumps(val))
-            f.write("\n")
-
-    os.system("gzip " + os.path.join(SAVE_PATH, "train.jsonl"))
-    os.system("gzip " + os.path.join(SAVE_PATH, "val.jsonl"))
-    os.system("rm -r " + os.path.join(SAVE_PATH, "MATH"))
-    os.remove(archive_path)
-
-if __name__=="__main__": 
+    archive_path = cached_download(ARCHIVE_URL)
+
+    problems = {}
+    with stage("parse"), Pool(workers or task_workers()) as pool:
+        batches = _iter_problem_batches(archive_path, batch_size)
+        for formatted in pool.imap(_format_batch, batches):
+            count("docs_in", len(formatted))
+            for split, category, name, text in formatted:
+                problems.setdefault((split, category), []).append((name, text))
+
+    with JsonlShardWriter(os.path.join(SAVE_PATH, "train.jsonl.gz")) as train_writer, \
+            JsonlShardWriter(os.path.join(SAVE_PATH, "val.jsonl.gz")) as val_writer, \
+            JsonlShardWriter(os.path.join(SAVE_PATH, "test.jsonl.gz")) as test_writer:
+        for (split, category), cat_problems in sorted(problems.items()):
+            # tar order is arbitrary, so sort before the seeded shuffle
+            cat_problems.sort(key=lambda x: _problem_number(x[0]))
+
+            if split == "test":
+                for name, text in cat_problems:
+                    test_writer.write({"text": text, "meta": {"set_name": "MATH",
+                        "file": "/".join(["test", category, name])}})
+                continue
+
+            cat_texts = [text for _, text in cat_problems]
+            random.Random(f"{SEED}-{category}").shuffle(cat_texts)
+            instances = [{"text": x, "meta": {"set_name": "MATH"}} for x in cat_texts]
+            split_idx = int(VAL_RATE*len(instances))
+
+            for instance in instances[split_idx:]:
+                train_writer.write(instance)
+            for instance in instances[:split_idx]:
+                val_writer.write(instance)
+
+if __name__=="__main__":
     main()
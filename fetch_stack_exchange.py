@@ -1,23 +1,23 @@
 from dataclasses import dataclass, field, fields
-from functools import lru_cache
 from xml.etree import ElementTree
 from datetime import datetime
 from enum import Enum
 import typing
-from typing import List, Optional, Union
+from typing import List, Optional, Sequence, Union
 import os.path
-from itertools import groupby
 import dataclasses
 from tqdm import tqdm
-from bs4 import BeautifulSoup
 import sys
 from pathlib import Path
-import tarfile
-import random
-import ndjson
+import subprocess
+from contextlib import contextmanager
 import json
+import gzip
+import hashlib
 
-from utils import make_archive
+from metrics import count, reject, stage
+from profiler import profile
+from utils import SplitWriter
 
 """
 Author: E.W.Ayers
@@ -26,20 +26,13 @@ This code takes a dump of math overflow XML and produces
 a structured set of questions with answers.
 
 1. Get mathoverflow.net.7z file
-2. Extract this to `DATA_DIR = 'data/mathoverflow.net'`
+2. Either extract this to `DATA_DIR = 'data/mathoverflow.net'`, or point
+   `ARCHIVE_PATH` at the .7z file to stream the tables straight out of the archive.
 3. Run `questions()` and run it to get a dictionary of mathoverflow questions.
    Each question has an `Answers` field that contains a list of answers for the given q.
 """
 
 
-def batch_loader(seq, size):
-    """
-    Iterator that takes in a list `seq` and returns
-    chunks of size `size`
-    """
-    return [seq[pos : pos + size] for pos in range(0, len(seq), size)]
-
-
 DOC_SEP = "<|endoftext|>"
 
 # source: https://meta.stackexchange.com/questions/2677/database-schema-documentation-for-the-public-data-dump-and-sede
@@ -101,81 +94,130 @@ def skip(default):
     return field(default=default, metadata={"from_xml": "skip"})
 
 
-def iter_rows(path):
-    for [_, element] in ElementTree.iterparse(path, events=["start"]):
+def iter_rows(source):
+    """
+    `source` is a path or a binary file object. Rows are detached from the root
+    once consumed, so memory does not grow with the size of the table.
+    """
+    root = None
+    for [_, element] in ElementTree.iterparse(source, events=["start"]):
+        if root is None:
+            root = element
         if element.tag == "row":
             yield element
+            root.clear()
+
+
+@contextmanager
+def open_archive_member(archive_path, member):
+    """
+    Pipes a single file out of a .7z archive, without extracting anything to disk.
+    The stream is meant to be read to the end, after which 7z must have exited
+    cleanly; if the caller stops early, 7z is killed.
+    """
+    proc = subprocess.Popen(
+        ["7z", "e", "-so", archive_path, member],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        yield proc.stdout
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def xml_rows(name):
+    """
+    Rows of the table `name` (e.g. "Posts.xml"), read from `ARCHIVE_PATH` if it is set
+    and from `DATA_DIR` otherwise.
+    """
+    if ARCHIVE_PATH is not None:
+        with open_archive_member(ARCHIVE_PATH, name) as stream:
+            yield from iter_rows(stream)
+    else:
+        yield from iter_rows(os.path.join(DATA_DIR, name))
 
 
 DATA_DIR = "nothing"
+ARCHIVE_PATH = None
 
 
-@dataclass
+# Millions of these are alive at once, so they are slotted and only keep the
+# columns that are actually read. Dates stay as the raw ISO strings.
+@dataclass(slots=True)
 class Comment:
     Id: int
     PostId: int
     Score: int
     Text: str
-    CreationDate: datetime
     UserId: Optional[int]
 
 
 # lru_cache()
 def comments():
-    path = os.path.join(DATA_DIR, "Comments.xml")
     out = {}
-    for element in iter_rows(path):
+    for element in xml_rows("Comments.xml"):
         x: Comment = fromXML(Comment, element)
         out[x.Id] = x
     print(f"Processed {len(out)} comments.")
     return out
 
 
-@dataclass
+@dataclass(slots=True)
 class Post:
     Id: int
-    CreationDate: datetime
-    DeletionDate: Optional[datetime]
     Score: int
     Body: str  # in html; need to parse out?
     Title: Optional[str]
-    OwnerUserId: Optional[int]
-    ViewCount: Optional[int]
     AcceptedAnswerId: Optional[int]
     ParentId: Optional[int]
+    LastActivityDate: Optional[str]
     PostType: "PostType" = use(lambda x: PostType(int(x)), "PostTypeId")
-    Comments: List[Comment] = skip(None)
+    Comments: Sequence[Comment] = skip(())
     Answers: Optional[List["Post"]] = skip(None)
     Tags: str = field(default="")
 
 
 # @lru_cache()
-def questions():
-    path = os.path.join(DATA_DIR, "Posts.xml")
+@profile()
+def questions(with_comments=True):
     cs = {}
-    for k, c in groupby(comments().values(), lambda c: c.PostId):
-        x = list(c)
-        x.sort(key=lambda x: -x.Score)
-        cs[k] = x
+    if with_comments:
+        for c in comments().values():
+            cs.setdefault(c.PostId, []).append(c)
+        for x in cs.values():
+            x.sort(key=lambda x: -x.Score)
     qs = {}
     answers = {}
-    for element in iter_rows(path):
+    num_answers = 0
+    for element in xml_rows("Posts.xml"):
         post = fromXML(Post, element)
-        post.Comments = cs.get(post.Id, [])
+        post.Comments = cs.get(post.Id, ())
         if post.PostType is PostType.Question:
             post.Answers = []
             qs[post.Id] = post
         elif post.PostType is PostType.Answer:
-            answers[post.Id] = post
-    for qk, aa in groupby(answers.values(), lambda a: a.ParentId):
-        x = list(aa)
-        x.sort(key=lambda x: -x.Score)
-        qs[qk].Answers = x
-    print(f"Processed {len(qs)} questions with {len(answers)} answers.")
+            answers.setdefault(post.ParentId, []).append(post)
+            num_answers += 1
+    for qk, x in answers.items():
+        if qk in qs:
+            x.sort(key=lambda x: -x.Score)
+            qs[qk].Answers = x
+    count("questions", len(qs))
+    count("answers", num_answers)
+    print(f"Processed {len(qs)} questions with {num_answers} answers.")
     return qs
 
 
 def strip_html(string):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(string, "html.parser")
     return soup.get_text()
 
@@ -200,31 +242,115 @@ def text_of_post(post):
     return text, post.Score, post.Id, answered
 
 
-def get_and_format(url, save_dir):
+def is_kept(post):
+    """
+    Whether `get_and_format` keeps a question. Agrees with the score and
+    `answered` filter on the output of `text_of_post`, without rendering.
+    """
+    return post.Score >= 5 and any(answer.Score >= 2 for answer in post.Answers)
+
+
+def fingerprint_of_post(post):
+    """
+    Changes whenever the question, or any of its answers, is edited, voted on
+    or answered. Votes do not bump `LastActivityDate`, so scores are included.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"{post.LastActivityDate}|{post.Score}".encode("utf-8"))
+    for answer in post.Answers:
+        h.update(f"|{answer.Id}:{answer.LastActivityDate}:{answer.Score}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_index(path):
+    """
+    Reads the per-site index of a previous build, which maps
+    question_id -> (LastActivityDate, fingerprint, content hash). The content
+    hash is empty for questions that were filtered out.
+    """
+    index = {}
+    if os.path.exists(path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                eyed, last_activity, fingerprint, content_hash = line.rstrip("\n").split("\t")
+                index[int(eyed)] = (last_activity, fingerprint, content_hash)
+    return index
+
+
+def save_index(index, path):
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        for eyed, (last_activity, fingerprint, content_hash) in index.items():
+            f.write(f"{eyed}\t{last_activity}\t{fingerprint}\t{content_hash}\n")
+    os.replace(path + ".tmp", path)
+
+
+def get_and_format(url, save_dir, delta=False):
+    """
+    With `delta=True`, the index and shards of a previous build in `save_dir`
+    are reused: only questions whose fingerprint changed are re-rendered. The
+    train/val shards are still rewritten in full, with the lines of unchanged
+    questions copied over from the old shards as they are.
+    """
     VAL_RATE = 0.05
     Path(save_dir).mkdir(exist_ok=True, parents=True)
     archive_path = os.path.join(save_dir, "archive.7z")
-    os.system(f"wget -O {archive_path} {url}")
-
-    global DATA_DIR
-    DATA_DIR = os.path.join(save_dir, "xml")
-    print(f"DATA DIR {DATA_DIR}")
-    os.system(f"7z e {archive_path} -o{DATA_DIR}")
+    index_path = os.path.join(save_dir, "index.tsv.gz")
+    shard_paths = {
+        "train": os.path.join(save_dir, "train.jsonl.gz"),
+        "val": os.path.join(save_dir, "val.jsonl.gz"),
+    }
+    with stage("download", url=url):
+        os.system(f"wget -O {archive_path} {url}")
+        count("bytes_read", os.path.getsize(archive_path))
+
+    # stream Posts.xml straight out of the archive, the other tables are never read
+    global ARCHIVE_PATH
+    ARCHIVE_PATH = archive_path
 
     print("parsing xml...")
-    qs = questions()
+    with stage("parse"):
+        qs = questions(with_comments=False)
+
+    old_index = load_index(index_path) if delta else {}
+    index = {}
+    unchanged = set()
+    to_render = []
+    evaluated = 0
+    for key, post in qs.items():
+        fingerprint = fingerprint_of_post(post)
+        old = old_index.get(key)
+        if old is not None and old[1] == fingerprint:
+            index[key] = old
+            if old[2]:
+                unchanged.add(key)
+        else:
+            evaluated += 1
+            index[key] = (post.LastActivityDate or "", fingerprint, "")
+            if is_kept(post):
+                to_render.append(key)
+    count("unchanged", len(unchanged))
+    # questions rejected by an earlier build and unchanged since are not counted again
+    reject("low_score_or_unanswered", evaluated - len(to_render))
+    print(f"{len(unchanged)} kept questions unchanged, {len(to_render)} to render")
 
     print("converting xml to text...")
-    qs_texts = [text_of_post(qs[key]) for key in tqdm(qs.keys())]
-
-    for post, score, eyed, answered in tqdm(qs_texts):
-        if score >= 5 and answered:
-            if random.random() > VAL_RATE:
-                shard_path = os.path.join(save_dir, "train.jsonl")
-            else:
-                shard_path = os.path.join(save_dir, "val.jsonl")
-
-            with open(shard_path, "a+") as f:
+    with stage("render"):
+        qs_texts = [text_of_post(qs[key]) for key in tqdm(to_render)]
+
+    with stage("write"), \
+            SplitWriter(shard_paths["train"], shard_paths["val"], VAL_RATE) as writer:
+        if unchanged:
+            for split, shard_path in shard_paths.items():
+                if not os.path.exists(shard_path):
+                    continue
+                with gzip.open(shard_path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        eyed = json.loads(line)["meta"]["question_id"]
+                        if eyed in unchanged:
+                            writer.writers[split].write_line(line)
+
+        for post, score, eyed, answered in tqdm(qs_texts):
+            if score >= 5 and answered:
                 instance = {
                             "text": post,
                             "meta": {
@@ -233,38 +359,45 @@ def get_and_format(url, save_dir):
                                 "question_id": eyed,
                             },
                         }
-                f.write(json.dumps(instance))
-                f.write("\n")
+                writer.write(instance, key=eyed)
+                content_hash = hashlib.blake2b(post.encode("utf-8"), digest_size=8).hexdigest()
+                index[eyed] = index[eyed][:2] + (content_hash,)
 
-    os.system("gzip " + " ".join(os.path.join(save_dir, x)
-        for x in ("train.jsonl", "val.jsonl")))
+    save_index(index, index_path)
 
-    os.system(f"rm -r {DATA_DIR}")
+    ARCHIVE_PATH = None
     os.remove(archive_path)
 
 
 if __name__ == "__main__":
+    delta = "--delta" in sys.argv[1:]
     get_and_format(
         "https://archive.org/download/stackexchange/mathoverflow.net.7z",
         save_dir="stack-exchange/math_overflow",
+        delta=delta,
     )
     get_and_format(
         "https://archive.org/download/stackexchange/math.stackexchange.com.7z",
         "stack-exchange/math_stack_exchange",
+        delta=delta,
     )
     get_and_format(
         "https://archive.org/download/stackexchange/physics.stackexchange.com.7z", 
-        "stack-exchange/physics_stack_exchange", 
+        "stack-exchange/physics_stack_exchange",
+        delta=delta,
     )
     get_and_format(
         "https://archive.org/download/stackexchange/cstheory.stackexchange.com.7z", 
-        "stack-exchange/cstheory_stack_exchange", 
+        "stack-exchange/cstheory_stack_exchange",
+        delta=delta,
     )
     get_and_format(
         "https://archive.org/download/stackexchange/datascience.stackexchange.com.7z", 
-        "stack-exchange/datascience_stack_exchange", 
+        "stack-exchange/datascience_stack_exchange",
+        delta=delta,
     )
     get_and_format(
         "https://archive.org/download/stackexchange/proofassistants.stackexchange.com.7z", 
         "stack-exchange/proofassistants_stack_exchange",
+        delta=delta,
     )
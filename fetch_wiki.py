@@ -1,116 +1,357 @@
-from bs4 import BeautifulSoup as bs
 import os
-import wikipediaapi
 import sys
 import re
-import pypandoc
 import json
+import bz2
+import time
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
+from xml.etree import ElementTree
+from tqdm import tqdm
 
-from fetch_books_and_formal import _download_with_progress_bar
-from utils import make_archive
+from cache import cached_download
+from metrics import count, reject, stage
+from utils import SplitWriter, iter_json_arrays, task_workers
 
-import random
 
-random.seed(20)
+WIKIPEDIA_API = "https://en.wikipedia.org/w/api.php"
 
 
-def page_titles_of_category(cat_page):
+class CategoryCrawler:
+    """
+    Breadth-first crawl of Wikipedia's category graph through the MediaWiki
+    `categorymembers` API.
+
+    Each category is visited at most once, so cycles and shared subtrees cost
+    nothing, and the crawl stops `max_depth` levels below the seeds. Members of
+    each category are cached on disk under `cache_dir` for `ttl` seconds, so a
+    re-run with new seeds only fetches the uncached frontier. At most
+    `max_in_flight` requests are open at once.
+
+    `api_url` can point at any server that mimics the MediaWiki API.
+    """
+    def __init__(self, api_url=WIKIPEDIA_API, cache_dir="wiki/category_cache",
+            ttl=30 * 24 * 3600, max_depth=8, max_in_flight=8, retries=3):
+        self.api_url = api_url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_depth = max_depth
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = (
+            "proof-pile (https://github.com/zhangir-azerbayev/proof-pile)"
+        )
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _cache_path(self, category):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(category.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def _get(self, params):
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.session.get(self.api_url, params=params, timeout=60)
+                if resp.status_code == 200:
+                    return resp.json()
+            except requests.RequestException:
+                pass
+            if attempt < self.retries:
+                time.sleep(2**attempt)
+        raise AssertionError(f"Failed to fetch members of {params['cmtitle']}")
+
+    def members(self, category):
         """
-        recursively
+        Returns `(pages, subcategories)` of `category`, e.g. "Category:Lemmas".
         """
-        titles = []
-        for member in cat_page.categorymembers.values(): 
-            if member.ns == wikipediaapi.Namespace.MAIN: 
-                titles.append(member.title)
-            elif member.ns == wikipediaapi.Namespace.CATEGORY: 
-                titles += page_titles_of_category(member)
+        path = self._cache_path(category)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+            with open(path, encoding="utf-8") as f:
+                cached = json.load(f)
+            return cached["pages"], cached["subcats"]
+
+        pages, subcats = [], []
+        params = {
+            "action": "query",
+            "format": "json",
+            "list": "categorymembers",
+            "cmtitle": category,
+            "cmtype": "page|subcat",
+            "cmlimit": "max",
+        }
+        while True:
+            resp = self._get(params)
+            for member in resp["query"]["categorymembers"]:
+                if member["ns"] == 0:
+                    pages.append(member["title"])
+                elif member["ns"] == 14:
+                    subcats.append(member["title"])
+            if "continue" not in resp:
+                break
+            params.update(resp["continue"])
+
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"category": category, "pages": pages, "subcats": subcats}, f)
+        os.replace(path + ".tmp", path)
+        return pages, subcats
+
+    def crawl(self, seeds):
+        """
+        Titles of all pages in the category closure of `seeds`.
+        """
+        titles = set()
+        visited = set(seeds)
+        frontier = list(seeds)
+        with ThreadPoolExecutor(self.max_in_flight) as executor:
+            for depth in range(self.max_depth + 1):
+                if not frontier:
+                    break
+                print(f"depth {depth}: {len(frontier)} categories")
+                next_frontier = []
+                for pages, subcats in executor.map(self.members, frontier):
+                    titles.update(pages)
+                    for subcat in subcats:
+                        if subcat not in visited:
+                            visited.add(subcat)
+                            next_frontier.append(subcat)
+                frontier = next_frontier
         return titles
 
-def wikipedia(): 
+    def evict(self):
+        """
+        Deletes cache entries older than the ttl.
+        """
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if now - entry.stat().st_mtime >= self.ttl:
+                os.remove(entry.path)
+
+
+def page_titles_of_category(category, crawler=None):
+    return sorted((crawler or CategoryCrawler()).crawl([category]))
+
+
+def write_category_closure(seeds=None, path=None, crawler=None):
+    """
+    Writes the titles in the closure of `seeds` to `path`, for `wikipedia`.
+    """
+    seeds = seeds or WIKIPEDIA_CATEGORIES
+    path = path or WIKIPEDIA_TITLES
+    crawler = crawler or CategoryCrawler()
+    crawler.evict()
+    titles = crawler.crawl(seeds)
+    with open(path, "w", encoding="utf-8") as f:
+        for title in sorted(titles):
+            f.write(title + "\n")
+    return titles
+
+
+WIKIPEDIA_CATEGORIES = [
+    #"Category:Mathematical_theorems",
+    "Category:Mathematical_proofs",
+    #"Category:Mathematical_examples",
+    #"Category:Mathematical_problems",
+    #"Category:Mathematical_terminology",
+]
+
+# https://dumps.wikimedia.org/enwiki/latest/
+WIKIPEDIA_DUMP = "wiki/enwiki-latest-pages-articles-multistream.xml.bz2"
+WIKIPEDIA_INDEX = "wiki/enwiki-latest-pages-articles-multistream-index.txt.bz2"
+# the category closure of WIKIPEDIA_CATEGORIES, one title per line
+WIKIPEDIA_TITLES = "wiki/math_titles.txt"
+WIKIPEDIA_SHARDS = ("wiki/wikipedia_train.jsonl.gz", "wiki/wikipedia_val.jsonl.gz")
+
+
+def _wikipedia_offsets(index_path, titles):
     """
-    this doesnt work dont run it
+    Maps the offset of each bz2 stream in the dump that holds a wanted page
+    to the ids of the wanted pages in it.
     """
-    init_categories = [
-        #"Category:Mathematical_theorems",
-        "Category:Mathematical_proofs",
-        #"Category:Mathematical_examples",
-        #"Category:Mathematical_problems",
-        #"Category:Mathematical_terminology",
-    ]
-
-    title_set = set()
-    for cat_name in init_categories: 
-        print(cat_name + "...")
-        title_set = title_set.union(page_titles_of_category(wiki.page(cat_name)))
-    
+    offsets = {}
+    with bz2.open(index_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            offset, page_id, title = line.rstrip("\n").split(":", 2)
+            if title in titles:
+                offsets.setdefault(int(offset), set()).add(page_id)
+    return offsets
+
+
+def _wikipedia_pages_of_stream(args):
+    """
+    Runs in a worker: decompresses the single bz2 stream at `offset`, and
+    converts the wanted pages in it from wikitext to plain text. The text is
+    None for pages pandoc fails on.
+    """
+    import pypandoc
+
+    dump_path, offset, page_ids = args
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    with open(dump_path, "rb") as f:
+        f.seek(offset)
+        while not decompressor.eof:
+            data = f.read(1 << 18)
+            if not data:
+                break
+            chunks.append(decompressor.decompress(data))
+
+    root = ElementTree.fromstring(b"<pages>" + b"".join(chunks) + b"</pages>")
+    out = []
+    for page in root.iter("page"):
+        page_id = page.findtext("id")
+        if page_id not in page_ids or page.find("redirect") is not None:
+            continue
+        wikitext = page.findtext("revision/text") or ""
+        try:
+            text = pypandoc.convert_text(wikitext, "plain", format="mediawiki").strip()
+        except RuntimeError:
+            text = None
+        out.append((page_id, page.findtext("title"), text))
+    return out
+
+
+def wikipedia(dump_path=WIKIPEDIA_DUMP, index_path=WIKIPEDIA_INDEX,
+        titles_path=WIKIPEDIA_TITLES, workers=None):
+    """
+    Extracts the math pages of a local multistream Wikipedia dump into
+    wiki/wikipedia_{train,val}.jsonl.gz. Only the bz2 streams that hold a page
+    listed in `titles_path` are decompressed, in parallel across processes.
+    """
+    VAL_RATE = 0.025
+    Path("wiki").mkdir(parents=True, exist_ok=True)
+
+    with open(titles_path, encoding="utf-8") as f:
+        titles = {line.strip().replace("_", " ") for line in f if line.strip()}
+
+    offsets = _wikipedia_offsets(index_path, titles)
+    print(f"{len(titles)} titles in {len(offsets)} streams")
+
+    jobs = [(dump_path, offset, page_ids) for offset, page_ids in sorted(offsets.items())]
+    with Pool(workers or task_workers()) as pool, SplitWriter(*WIKIPEDIA_SHARDS, VAL_RATE) as writer:
+        for pages in tqdm(pool.imap_unordered(_wikipedia_pages_of_stream, jobs), total=len(jobs)):
+            count("docs_in", len(pages))
+            for page_id, title, text in pages:
+                if text is None:
+                    reject("pandoc_failure")
+                    continue
+                if not text:
+                    reject("empty")
+                    continue
+                writer.write(
+                    {
+                        "text": text,
+                        "meta": {"set_name": "wikipedia", "id": int(page_id), "title": title},
+                    },
+                    key=f"wikipedia_{page_id}",
+                )
+
 
 PROOFWIKI_URL = (
     "https://zenodo.org/record/4902289/files/naturalproofs_proofwiki.json?download=1"
 )
+def format_theorem(thm):
+    thm_string = "\\section{" + thm["label"] + "}\n"
+    thm_string += (
+        "Tags: " + ", ".join(thm["categories"]).replace("/", ": ") + "\n\n"
+    )
+
+    thm_string += (
+        "\\begin{theorem}\n"
+        + "\n".join(thm["contents"])
+        + "\n\\end{theorem}\n\n"
+    )
+
+    for proof in thm["proofs"]:
+        thm_string += (
+            "\\begin{proof}\n"
+            + "\n".join(proof["contents"])
+            + "\n\\end{proof}\n\n"
+        )
+    return thm_string
+
+
+def format_definition(defn):
+    return (
+        "\\begin{definition}["
+        + defn["label"]
+        + "]\n"
+        + "\n".join(defn["contents"])
+        + "\n\\end{definition}").strip()
+
+
+def _proofwiki_instance(text, kind, item):
+    return {
+        "text": text,
+        "meta": {
+            "set_name": "proofwiki",
+            "type": kind,
+            "id": item["id"],
+            "label": item["label"],
+            "categories": item.get("categories", []),
+        },
+    }
+
+
 def proofwiki(testing=False):
+    """
+    Writes ProofWiki theorems and definitions straight into
+    wiki/proofwiki_{train,val}.jsonl.gz, split by a hash of their ids.
+    """
     VAL_RATE = 0.025
-    save_dir = "wiki/proofwiki"
-    val_dir = "wiki/proofwiki_val"
-    Path(save_dir).mkdir(parents=True, exist_ok=True)
-    Path(val_dir).mkdir(parents=True, exist_ok=True)
+    Path("wiki").mkdir(parents=True, exist_ok=True)
 
     if testing:
-        with open("naturalproofs/proofwiki.json") as f:
-            struct = json.load(f)
+        path = "naturalproofs/proofwiki.json"
     else:
         print("DOWNLOADING PROOFWIKI")
-        resp = _download_with_progress_bar(PROOFWIKI_URL)
-        struct = json.loads(resp.decode("utf-8"))
+        path = cached_download(PROOFWIKI_URL)
         print("DONE DOWNLOADING PROOFWIKI")
-    
-    for i, thm in enumerate(struct["dataset"]["theorems"]):
-        if thm["contents"]:
-            thm_string = "\\section{" + thm["label"] + "}\n"
-            thm_string += (
-                "Tags: " + ", ".join(thm["categories"]).replace("/", ": ") + "\n\n"
-            )
-
-            thm_string += (
-                "\\begin{theorem}\n"
-                + "\n".join(thm["contents"])
-                + "\n\\end{theorem}\n\n"
-            )
-
-            for proof in thm["proofs"]:
-                thm_string += (
-                    "\\begin{proof}\n"
-                    + "\n".join(proof["contents"])
-                    + "\n\\end{proof}\n\n"
+
+    targets = [("dataset", "theorems"), ("dataset", "definitions")]
+    with open(path, encoding="utf-8") as f, SplitWriter(
+        "wiki/proofwiki_train.jsonl.gz", "wiki/proofwiki_val.jsonl.gz", VAL_RATE
+    ) as writer:
+        for (_, kind), item in iter_json_arrays(f, targets):
+            count("docs_in")
+            if not item["contents"]:
+                reject("empty")
+                continue
+            if kind == "theorems":
+                writer.write(
+                    _proofwiki_instance(format_theorem(item), "theorem", item),
+                    key=f"""thm_{item["id"]}""",
+                )
+            else:
+                writer.write(
+                    _proofwiki_instance(format_definition(item), "definition", item),
+                    key=f"""def_{item["id"]}""",
                 )
 
-            if random.random()>VAL_RATE: 
-                with open(os.path.join(save_dir, f"""thm_{thm["id"]}.txt"""), "w") as f:
-                    f.write(thm_string)
-            else: 
-                with open(os.path.join(val_dir, f"""thm_{thm["id"]}.txt"""), "w") as f: 
-                    f.write(thm_string)
-
-    defn_strings = []
-    for defn in struct["dataset"]["definitions"]:
-        if defn["contents"]:
-            defn_string = (
-                "\\begin{definition}["
-                + defn["label"]
-                + "]\n"
-                + "\n".join(defn["contents"])
-                + "\n\\end{definition}").strip()
-            
-            if random.random()>VAL_RATE:
-                with open(os.path.join(save_dir, f"""def_{defn["id"]}.txt"""), "w") as f:
-                    f.write(defn_string)
-            else: 
-                with open(os.path.join(val_dir, f"""def_{defn["id"]}.txt"""), "w") as f: 
-                    f.write(defn_string)
-              
+
+def main(): 
+    if os.path.exists(WIKIPEDIA_DUMP): 
+        if not os.path.exists(WIKIPEDIA_TITLES): 
+            with stage("categories"):
+                write_category_closure()
+        with stage("wikipedia"):
+            wikipedia()
+    elif not all(os.path.exists(x) for x in WIKIPEDIA_SHARDS):
+        # the aggregator always lists the wikipedia shards
+        print(f"no Wikipedia dump at {WIKIPEDIA_DUMP}, writing empty wikipedia shards")
+        Path("wiki").mkdir(parents=True, exist_ok=True)
+        with SplitWriter(*WIKIPEDIA_SHARDS, val_rate=0):
+            pass
+    with stage("proofwiki"):
+        proofwiki()
 
 if __name__=="__main__": 
-    #wikipedia()
-    proofwiki()
-    make_archive("wiki/proofwiki")
-    make_archive("wiki/proofwiki_val")
+    main()
@@ -1,40 +1,226 @@
 import os 
-import random 
+import sys
+import glob
+import gzip
 import json
+import mmap
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
 
-random.seed(20)
+from utils import split_of_key
 
-def _get_filepaths(path): 
-    filepaths = []
-    for f in os.listdir(path): 
-        f_path = os.path.join(path, f)
-        if os.path.isfile(f_path): 
-            filepaths.append(os.path.normpath(f_path))
-        elif os.path.isdir(f_path): 
-            filepaths += _get_filepaths(f_path)
+VAL_RATE = 0.05
+OVERRIDES_PATH = "split_overrides.json"
 
-    return filepaths
+MUST_BE_IN_TRAIN = {
+    "books": ["books/stein/stein.tex", "books/trench/TRENCH_REAL_ANALYSIS.tex"],
+    "formal": ["formal/setmm/set.mm"],
+}
 
-def get_split(path, train_split: float, must_be_in_train):
-    filepaths = _get_filepaths(path)
-    random.shuffle(filepaths)
+def normalize_path(path):
+    """
+    The form of a path that is hashed, so that "./books/x.tex" and
+    "books//x.tex" land in the same split on every platform.
+    """
+    return os.path.normpath(path).replace(os.sep, "/")
 
-    boundary = int(train_split * len(filepaths))
+@lru_cache(maxsize=None)
+def load_overrides(path=OVERRIDES_PATH):
+    """
+    Paths pinned to "train" or "valid" regardless of their hash: those in
+    `MUST_BE_IN_TRAIN`, and those in `path`, see `migrate_splits`.
+    """
+    overrides = {normalize_path(x): "train" for paths in MUST_BE_IN_TRAIN.values()
+            for x in paths}
+    if os.path.exists(path):
+        with open(path) as f:
+            overrides.update((normalize_path(k), v) for k, v in json.load(f).items())
+    return overrides
 
-    train_paths = filepaths[:boundary]
-    valid_paths = filepaths[boundary:]
+def assign_split(path, val_rate=VAL_RATE, overrides=None):
+    """
+    "train" or "valid", from a keyed hash of the normalized path. A file's
+    split never depends on which other files exist, so adding or removing
+    files leaves every other assignment alone.
+    """
+    normed_path = normalize_path(path)
+    overrides = load_overrides() if overrides is None else overrides
+    if normed_path in overrides:
+        return overrides[normed_path]
+    return "valid" if split_of_key(normed_path, val_rate) == "val" else "train"
 
-    print("TRAIN SPLIT (number in train, number in val): ", len(train_paths), len(valid_paths))
+def emitted_split(subdir, split):
+    """
+    The files written to the `split` ("train" or "val") shards of `subdir`,
+    as recorded in each document's `meta["file"]`. The books and formal
+    sources are streamed into their shards, so the shards are the only
+    record of which files went where.
+    """
+    paths = set()
+    for shard in sorted(glob.glob(os.path.join(subdir, f"*_{split}.jsonl.gz"))):
+        with gzip.open(shard, "rt", encoding="utf-8") as f:
+            for line in f:
+                paths.add(normalize_path(json.loads(line)["meta"]["file"]))
+    return sorted(paths)
 
-    for path in must_be_in_train: 
-        normed_path = os.path.normpath(path)
-        assert normed_path in train_paths or normed_path in valid_paths, f"{normed_path} not in paths"
-        if normed_path in valid_paths: 
-            print(f"MOVING {path} to validation set")
-            valid_paths.remove(path)
-            train_paths.append(path)
+def migrate_splits(splits_path="splits.json", overrides_path=OVERRIDES_PATH,
+        subdirs=("books", "formal"), val_rate=VAL_RATE):
+    """
+    Freezes the assignments of an existing splits.json, made by the old
+    shuffle-and-cut split: every path whose hash would put it in the
+    other split is pinned in `overrides_path`. Only the disagreements are
+    stored, and files added later are assigned by hash alone.
+    """
+    with open(splits_path) as f:
+        splits = json.load(f)
+
+    overrides = dict(load_overrides(overrides_path))
+    for subdir in subdirs:
+        for split in ("train", "valid"):
+            for path in splits.get(f"{subdir}-{split}", []):
+                normed_path = normalize_path(path)
+                if assign_split(normed_path, val_rate, {}) != split:
+                    overrides[normed_path] = split
+                else:
+                    overrides.pop(normed_path, None)
+
+    with open(overrides_path + ".tmp", "w") as f:
+        json.dump(overrides, f, indent=4, sort_keys=True)
+    os.replace(overrides_path + ".tmp", overrides_path)
+    load_overrides.cache_clear()
+    print(f"pinned {len(overrides)} paths in {overrides_path}")
+    return overrides
+
+INDEX_PATH = "splits.idx"
+_INDEX_MAGIC = b"PPSPLIT1"
+_INDEX_HEADER = struct.Struct("<8sI")
+_INDEX_ENTRY = struct.Struct("<QQ")
+
+def path_hash(path):
+    """
+    64 bit hash of a normalized path, the form in which paths are stored in
+    the split index. With around a million files a collision is vanishingly
+    unlikely.
+    """
+    digest = hashlib.blake2b(normalize_path(path).encode("utf-8"), digest_size=8,
+            person=b"split-idx").digest()
+    return int.from_bytes(digest, "little")
+
+def write_split_index(splits, path=INDEX_PATH):
+    """
+    Writes `splits`, a dict of split name to paths, as a binary index: a
+    header naming each split with the offset and length of its array,
+    followed by one sorted array of little endian uint64 path hashes per split.
+    """
+    names = sorted(splits)
+    arrays = {}
+    for name in names:
+        arrays[name] = array("Q", sorted({path_hash(x) for x in splits[name]}))
+        if sys.byteorder != "little":
+            arrays[name].byteswap()
+
+    header = [_INDEX_HEADER.pack(_INDEX_MAGIC, len(names))]
+    for name in names:
+        encoded = name.encode("utf-8")
+        header.append(struct.pack("<H", len(encoded)) + encoded)
+    size = sum(map(len, header)) + _INDEX_ENTRY.size * len(names)
+    offset = (size + 7) // 8 * 8
+    for name in names:
+        header.append(_INDEX_ENTRY.pack(offset, len(arrays[name])))
+        offset += 8 * len(arrays[name])
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(b"".join(header))
+        f.write(b"\0" * ((size + 7) // 8 * 8 - size))
+        for name in names:
+            arrays[name].tofile(f)
+    os.replace(path + ".tmp", path)
+
+def read_split_index(path=INDEX_PATH):
+    """
+    The arrays of a split index as a dict of split name to sorted sequences
+    of path hashes. They are memoryviews over an mmap of `path`, so nothing
+    is parsed or copied up front.
+    """
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, n = _INDEX_HEADER.unpack_from(buf, 0)
+    if magic != _INDEX_MAGIC:
+        raise ValueError(f"{path} is not a split index")
+
+    pos = _INDEX_HEADER.size
+    names = []
+    for _ in range(n):
+        (length,) = struct.unpack_from("<H", buf, pos)
+        names.append(bytes(buf[pos + 2:pos + 2 + length]).decode("utf-8"))
+        pos += 2 + length
+
+    index = {}
+    view = memoryview(buf)
+    for name in names:
+        offset, count = _INDEX_ENTRY.unpack_from(buf, pos)
+        pos += _INDEX_ENTRY.size
+        hashes = view[offset:offset + 8 * count]
+        if sys.byteorder == "little":
+            index[name] = hashes.cast("Q")
+        else:
+            index[name] = array("Q", hashes)
+            index[name].byteswap()
+    return index
+
+class SplitLookup:
+    """
+    Answers "which split is this file in?" by binary search over the sorted
+    path hashes of each split, instead of scanning the lists in splits.json.
+    """
+    def __init__(self, splits):
+        self._hashes = {
+            key: array("Q", sorted({path_hash(x) for x in paths}))
+            for key, paths in splits.items()
+        }
+
+    @classmethod
+    def from_index(cls, path=INDEX_PATH):
+        lookup = cls({})
+        lookup._hashes = read_split_index(path)
+        return lookup
+
+    def _contains(self, key, h):
+        hashes = self._hashes.get(key, ())
+        i = bisect_left(hashes, h)
+        return i < len(hashes) and hashes[i] == h
+
+    def split_of(self, path, keys):
+        """
+        Returns the first of `keys` whose split contains `path`.
+        """
+        h = path_hash(path)
+        for key in keys:
+            if self._contains(key, h):
+                return key
+        # files newer than the index are assigned by hash
+        if len(keys) == 2 and keys[0].endswith("-train") and keys[1].endswith("-valid"):
+            return keys[0] if assign_split(path) == "train" else keys[1]
+        raise KeyError(f"{path} not found in splits {keys}")
+
+
+@lru_cache(maxsize=None)
+def load_split_lookup(path=INDEX_PATH):
+    """
+    Maps the split index at `path` once per process. Falls back to parsing
+    splits.json when only that exists, and without either, e.g. before
+    gen_split has run, every file is assigned by hash.
+    """
+    if os.path.exists(path):
+        return SplitLookup.from_index(path)
+    if not os.path.exists("splits.json"):
+        return SplitLookup({})
+    with open("splits.json") as f:
+        return SplitLookup(json.load(f))
 
-    return train_paths, valid_paths
 
 def arxiv_split(): 
     train_paths = []
@@ -52,25 +238,24 @@ def arxiv_split():
 
 
 def main(): 
-    train_rate = 0.95
     splits = {}
 
-    args = [
-            ("books", ["books/stein/stein.tex", "books/trench/TRENCH_REAL_ANALYSIS.tex"]), 
-            ("formal", ["formal/setmm/set.mm"]), 
-           ]
+    if os.path.exists("splits.json") and not os.path.exists(OVERRIDES_PATH):
+        # keep the assignments of a splits.json made before hash-based splits
+        migrate_splits("splits.json", OVERRIDES_PATH)
 
-    for subdir, must_be_in_train in args: 
-        print(subdir, must_be_in_train)
-        train, valid = get_split(subdir, train_rate, must_be_in_train)
-        splits[subdir + "-train"] = train
-        splits[subdir + "-valid"] = valid 
+    for subdir in MUST_BE_IN_TRAIN: 
+        splits[subdir + "-train"] = emitted_split(subdir, "train")
+        splits[subdir + "-valid"] = emitted_split(subdir, "val")
+        print(subdir, len(splits[subdir + "-train"]), len(splits[subdir + "-valid"]))
 
     train, valid = arxiv_split()
     splits["arxiv-train"] = train
     splits["arxiv-valid"] = valid
     print("arxiv", len(train), len(valid))
 
+    write_split_index(splits, INDEX_PATH)
+    # kept for reading by hand, and by the aggregator for arxiv
     with open("splits.json", "w") as f: 
         f.write(json.dumps(splits, indent=4))
 
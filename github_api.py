@@ -0,0 +1,136 @@
+import base64
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import default_cache
+
+GITHUB_API = "https://api.github.com"
+
+
+class GithubFetcher:
+    """
+    Fetches git trees and blobs from the Github REST API over one pooled session.
+
+    At most `max_in_flight` requests are open at once. Failed requests are retried
+    with exponential backoff, and requests are spread out as the `X-RateLimit-*`
+    headers say we are running low, so that a long fetch never hits the limit.
+    A request that gets no response within `timeout` seconds is retried too.
+
+    Trees and blobs are addressed by their sha, so they are kept in the shared
+    artifact cache and only fetched once. Pass `cache=False` to bypass it.
+
+    `api_url` can point at any server that mimics the trees and blobs API.
+    """
+    def __init__(self, creds=None, max_in_flight=16, retries=5, backoff=1.0,
+            min_remaining=100, api_url=GITHUB_API, cache=None, timeout=60):
+        self.api_url = api_url.rstrip("/")
+        self.cache = default_cache() if cache is None else cache
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.min_remaining = min_remaining
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.auth = creds
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._reset_at = None
+
+    def _throttle(self):
+        with self._lock:
+            remaining, reset_at = self._remaining, self._reset_at
+        if remaining is None or reset_at is None or remaining >= self.min_remaining:
+            return
+        wait = reset_at - time.time()
+        if wait <= 0:
+            return
+        if remaining > 0:
+            # spread what is left of the budget evenly over the rest of the window
+            wait /= remaining
+        time.sleep(wait)
+
+    def _update_rate_limit(self, resp):
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        reset_at = resp.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset_at is None:
+            return
+        with self._lock:
+            self._remaining = int(remaining)
+            self._reset_at = float(reset_at)
+
+    def _retry_delay(self, resp, attempt):
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after is not None:
+                return float(retry_after)
+            if resp.headers.get("X-RateLimit-Remaining") == "0":
+                reset_at = resp.headers.get("X-RateLimit-Reset")
+                if reset_at is not None:
+                    return max(float(reset_at) - time.time(), 0) + 1
+        return self.backoff * 2**attempt
+
+    def get_json(self, url):
+        if url.startswith("/"):
+            url = self.api_url + url
+        for attempt in range(self.retries + 1):
+            self._throttle()
+            try:
+                resp = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                resp = None
+            else:
+                self._update_rate_limit(resp)
+                if resp.status_code == 200:
+                    return resp.json()
+                if resp.status_code not in (403, 429) and resp.status_code < 500:
+                    break
+            if attempt < self.retries:
+                time.sleep(self._retry_delay(resp, attempt))
+
+        status = resp.status_code if resp is not None else "connection error"
+        raise AssertionError(f"Failed to fetch {url} from Github API ({status})")
+
+    def _cached(self, key, fetch):
+        if not self.cache:
+            return fetch()
+        return self.cache.fetch(key, fetch)
+
+    def tree(self, author, repo, sha):
+        return self.subtree({"sha": sha, "url": f"/repos/{author}/{repo}/git/trees/{sha}"})
+
+    def subtree(self, tree):
+        """
+        `tree` is an entry of type "tree" of another tree.
+        """
+        data = self._cached(
+            "github-tree:" + tree["sha"],
+            lambda: json.dumps(self.get_json(tree["url"])["tree"]).encode("utf-8"),
+        )
+        return json.loads(data)
+
+    def blob(self, blob):
+        """
+        `blob` is an entry of a tree, the decoded contents are returned as bytes.
+        """
+        return self._cached(
+            "github-blob:" + blob["sha"],
+            lambda: base64.b64decode(self.get_json(blob["url"])["content"]),
+        )
+
+    def blobs(self, blobs):
+        """
+        Yields `(blob, contents)` pairs in the order of `blobs`, fetching concurrently.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            yield from zip(blobs, executor.map(self.blob, blobs))
@@ -1,4 +1,3 @@
-from datasets import load_dataset
 import random
 import itertools
 from itertools import islice
@@ -9,12 +8,8 @@ import re
 import json
 import ndjson
 
-
-def batch_loader(seq, size):
-    """
-    Iterator that takes in a list `seq` and returns
-    chunks of size `size` """
-    return [seq[pos:pos + size] for pos in range(0, len(seq), size)]
+from metrics import count, reject, stage, print_summary
+from utils import batch_loader
 
 
 def parse_meta(instance): 
@@ -45,44 +40,65 @@ def main(split):
     """
     `split` is `"train"` or `"validation"`
     """
-    arxiv = load_dataset("aggregator.py", "arxiv")
+    from datasets import load_dataset
+    import noise_filter
+
+    with stage("load_arxiv", split=split):
+        arxiv = load_dataset("aggregator.py", "arxiv")
 
-    print("PARSING ARXIV")
-    print("loading into memory...")
-    data_list = list(tqdm(arxiv[split]))
+        print("PARSING ARXIV")
+        print("loading into memory...")
+        data_list = list(tqdm(arxiv[split]))
+    count("arxiv_docs_in", len(data_list))
     print("processing...")
-    data_list = list(filter(filter_arxiv_text, tqdm(data_list)))
-    data_list = list(map(process_arxiv_text, tqdm(data_list)))
-    data_list = list(map(parse_meta, tqdm(data_list)))
+    with stage("filter_arxiv", split=split):
+        num_loaded = len(data_list)
+        data_list = list(filter(filter_arxiv_text, tqdm(data_list)))
+        reject("no_sectioning_or_gnuplot", num_loaded - len(data_list))
+    with stage("process_arxiv", split=split):
+        data_list = list(map(process_arxiv_text, tqdm(data_list)))
+    with stage("parse_meta", split=split):
+        data_list = list(map(parse_meta, tqdm(data_list)))
+    print("scoring noise...")
+    with stage("noise_arxiv", split=split):
+        data_list = noise_filter.filter_noise(data_list)
 
     #open("arxiv_examples.txt", "w").write("\n".join(["#"*80 + "\n" + x["text"] for x in eval_list[:100]]))
 
     keywords = ["formal", "books", "wiki", "stack-exchange", "math-dataset"]
     
     print("LOADING REST OF DATA...")
-    data_rest = [load_dataset("aggregator.py", x)[split] for x in keywords]
-    data_rest_list = list(itertools.chain.from_iterable(data_rest))
-    data_rest_list = list(map(parse_meta, tqdm(data_rest_list)))
+    with stage("load_rest", split=split):
+        data_rest = [load_dataset("aggregator.py", x)[split] for x in keywords]
+        data_rest_list = list(itertools.chain.from_iterable(data_rest))
+    count("rest_docs_in", len(data_rest_list))
+    with stage("parse_meta", split=split):
+        data_rest_list = list(map(parse_meta, tqdm(data_rest_list)))
     
     data_list = data_list + data_rest_list
     print("shuffling...")
-    random.shuffle(data_list)
-
-    if split=="train": 
-        for i, batch in enumerate(batch_loader(data_list, 100_000)):
-            with open(f"proofpile_train_{i}.jsonl", "w") as f: 
-                ndjson.dump(batch, f)
-
-    elif split=="validation": 
-        cut_idx = len(data_list)//2
-
-        with open("proofpile_dev.jsonl", "w") as f: 
-            ndjson.dump(data_list[:cut_idx], f)
-        with open("proofpile_test.jsonl", "w") as f: 
-            ndjson.dump(data_list[cut_idx:], f)
+    with stage("shuffle", split=split):
+        random.shuffle(data_list)
+
+    with stage("write", split=split):
+        if split=="train": 
+            for i, batch in enumerate(batch_loader(data_list, 100_000)):
+                with open(f"proofpile_train_{i}.jsonl", "w") as f: 
+                    ndjson.dump(batch, f)
+
+        elif split=="validation": 
+            cut_idx = len(data_list)//2
+
+            with open("proofpile_dev.jsonl", "w") as f: 
+                ndjson.dump(data_list[:cut_idx], f)
+            with open("proofpile_test.jsonl", "w") as f: 
+                ndjson.dump(data_list[cut_idx:], f)
+        count("docs_out", len(data_list))
             
     print("COMPLETE")
 
 if __name__=="__main__": 
+    start = time.time()
     main("train")
     main("validation")
+    print_summary(since=start)
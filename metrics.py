@@ -0,0 +1,219 @@
+"""
+Counters and per-stage timings for long builds, appended as json lines to
+`METRICS_PATH`, so that a build that runs for days leaves a record of what
+was slow and what was thrown away.
+
+    from metrics import count, reject, stage
+
+    with stage("stack-exchange", site="mathoverflow.net"):
+        for post in posts:
+            count("docs_in")
+            if not keep(post):
+                reject("low_score")
+                continue
+            count("docs_out")
+
+Each stage records its wall and CPU time and the RSS high-water mark when it
+ends. Counters are attributed to the innermost stage of the thread, or of the
+process that forked the current one, and are flushed at the end of every
+stage, on a heartbeat, and at exit. Every process appends to the same log.
+
+    python metrics.py [metrics.jsonl]    # summary table of a log
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+from contextlib import contextmanager
+from multiprocessing import util
+
+from profiler import profiled
+
+METRICS_PATH = os.environ.get("PROOF_PILE_METRICS", "metrics.jsonl")
+HEARTBEAT_SECONDS = float(os.environ.get("PROOF_PILE_METRICS_HEARTBEAT", 60))
+
+
+def max_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return max_rss_mb()
+
+
+class Metrics:
+    def __init__(self, path=METRICS_PATH, heartbeat=HEARTBEAT_SECONDS):
+        self.path = path
+        self.heartbeat = heartbeat
+        self._local = threading.local()
+        self._reset()
+
+    def _reset(self):
+        # also runs in forked children, which must not flush their parent's
+        # counts, nor wait on a lock held by a thread that did not survive the fork
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._heartbeat_thread = None
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current_stage(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def count(self, name, n=1):
+        key = (self.current_stage(), name)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+        if self._heartbeat_thread is None:
+            self._start_heartbeat()
+
+    def reject(self, reason, n=1):
+        self.count("rejected." + reason, n)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Times the enclosed block. Nested stages are named "outer/inner". Any
+        stage can also be profiled, see `profiler`.
+        """
+        stack = self._stack()
+        full_name = stack[-1] + "/" + name if stack else name
+        stack.append(full_name)
+        start = time.time()
+        cpu_start = time.process_time()
+        ok = False
+        try:
+            with profiled(full_name):
+                yield
+            ok = True
+        finally:
+            stack.pop()
+            self.flush()
+            self.write({
+                "event": "stage",
+                "stage": full_name,
+                "start": start,
+                "wall": time.time() - start,
+                "cpu": time.process_time() - cpu_start,
+                "max_rss_mb": round(max_rss_mb(), 1),
+                "ok": ok,
+                **fields,
+            })
+
+    def write(self, record):
+        record = {"time": time.time(), "pid": os.getpid(), **record}
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            # a single small append, so lines from concurrent processes do not interleave
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        by_stage = {}
+        for (stage_name, name), n in counters.items():
+            by_stage.setdefault(stage_name, {})[name] = n
+        for stage_name, values in by_stage.items():
+            self.write({"event": "counters", "stage": stage_name, "counters": values})
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat_thread is not None or not self.heartbeat:
+                return
+            self._heartbeat_thread = threading.Thread(target=self._beat,
+                    name="metrics-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def _beat(self):
+        pid = os.getpid()
+        while os.getpid() == pid:
+            time.sleep(self.heartbeat)
+            self.flush()
+            self.write({"event": "heartbeat", "rss_mb": round(rss_mb(), 1),
+                "max_rss_mb": round(max_rss_mb(), 1)})
+
+
+def _flush_at_exit(metrics):
+    # multiprocessing workers leave through os._exit, which skips atexit
+    util.Finalize(None, metrics.flush, exitpriority=0)
+
+
+_metrics = Metrics()
+os.register_at_fork(after_in_child=_metrics._reset)
+atexit.register(_metrics.flush)
+_flush_at_exit(_metrics)
+util.register_after_fork(_metrics, _flush_at_exit)
+
+count = _metrics.count
+reject = _metrics.reject
+stage = _metrics.stage
+flush = _metrics.flush
+
+
+def summarize(path=METRICS_PATH, since=None):
+    """
+    Totals of a metrics log: `(stages, counters)`, where `stages` maps each
+    stage to its calls, wall and CPU time and RSS high-water mark, and
+    `counters` maps each stage to its summed counters. With `since`, only
+    records written after that time are counted.
+    """
+    stages = {}
+    counters = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by a killed process
+                continue
+            if since is not None and record["time"] < since:
+                continue
+            if record["event"] == "stage":
+                s = stages.setdefault(record["stage"],
+                    {"calls": 0, "failed": 0, "wall": 0.0, "cpu": 0.0, "max_rss_mb": 0.0})
+                s["calls"] += 1
+                s["failed"] += not record["ok"]
+                s["wall"] += record["wall"]
+                s["cpu"] += record["cpu"]
+                s["max_rss_mb"] = max(s["max_rss_mb"], record["max_rss_mb"])
+            elif record["event"] == "counters":
+                c = counters.setdefault(record["stage"], {})
+                for name, n in record["counters"].items():
+                    c[name] = c.get(name, 0) + n
+    return stages, counters
+
+
+def print_summary(path=METRICS_PATH, since=None, file=None):
+    if not os.path.exists(path):
+        return
+    stages, counters = summarize(path, since)
+    out = file or sys.stdout
+    print(f"\n{'STAGE':<48} {'calls':>6} {'wall s':>10} {'cpu s':>10} {'max rss MB':>11}", file=out)
+    for name, s in sorted(stages.items(), key=lambda x: -x[1]["wall"]):
+        failed = f"  ({s['failed']} failed)" if s["failed"] else ""
+        print(f"{name:<48} {s['calls']:>6} {s['wall']:>10.1f} {s['cpu']:>10.1f} "
+                f"{s['max_rss_mb']:>11.1f}{failed}", file=out)
+    if counters:
+        print(f"\n{'STAGE':<48} {'COUNTER':<32} {'total':>14}", file=out)
+        for name in sorted(counters, key=lambda x: x or ""):
+            for counter, n in sorted(counters[name].items()):
+                print(f"{name or '-':<48} {counter:<32} {n:>14,}", file=out)
+
+
+if __name__ == "__main__":
+    print_summary(sys.argv[1] if len(sys.argv) > 1 else METRICS_PATH)
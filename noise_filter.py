@@ -0,0 +1,286 @@
+"""
+Flags unintelligible arXiv documents by their perplexity under a small byte
+n-gram language model, the CPU-only successor of the gpt-neo-125M scoring in
+`analysis/arxiv_noisedetection.ipynb`.
+
+The model is trained on the trusted books and formal train shards. It
+interpolates byte n-grams of every order up to `ORDER`, with counts kept in
+hashed tables of `2**BITS` buckets per order, so that scoring a document is a
+handful of vectorized NumPy lookups per byte. The cut-off is the `QUANTILE`
+quantile of the perplexities of the books and formal validation shards, that
+is, an arXiv document is dropped when it reads worse than nearly all of the
+held-out reference text.
+
+    python noise_filter.py train                  # writes noise_model.npz
+    python noise_filter.py score proofpile_dev.jsonl --top 20
+
+`make_jsons.py` scores every arXiv document, records its perplexity in
+`meta["perplexity"]` and drops the ones above the threshold, which
+`PROOF_PILE_NOISE_THRESHOLD` overrides.
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from metrics import count, reject, stage
+from utils import task_workers
+
+MODEL_PATH = "noise_model.npz"
+TRAIN_GLOBS = ["books/*_train.jsonl.gz", "formal/*_train.jsonl.gz"]
+VAL_GLOBS = ["books/*_val.jsonl.gz", "formal/*_val.jsonl.gz"]
+ORDER = 5
+BITS = 22
+ALPHA = 0.01
+QUANTILE = 0.995
+CHUNK_BYTES = 1 << 22
+
+# the byte before the start of a text, outside the 0-255 range of real bytes
+_PAD = 256
+_PRIME = np.uint64(0x100000001B3)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_NGRAM_SALT = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+class NgramModel:
+    """
+    Interpolated byte n-gram model over hashed count tables. Order `k` predicts
+    a byte from the `k - 1` bytes before it, with add-`alpha` smoothing, and
+    the orders are mixed with fixed `weights`, by default doubling with the order.
+    """
+    def __init__(self, order=ORDER, bits=BITS, alpha=ALPHA, weights=None):
+        self.order = order
+        self.bits = bits
+        self.alpha = alpha
+        if weights is None:
+            weights = [2.0**k for k in range(order)]
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        # uint64, as the order 1 context bucket counts every training byte
+        self.ngrams = np.zeros((order, 1 << bits), dtype=np.uint64)
+        self.contexts = np.zeros((order, 1 << bits), dtype=np.uint64)
+        self.trained_bytes = 0
+        self.threshold = None
+
+    def _buckets(self, data):
+        """
+        Yields `(k, context_buckets, ngram_buckets)` for every order `k + 1`,
+        each an array with one bucket per byte of `data`.
+        """
+        n = len(data)
+        padded = np.full(n + self.order - 1, _PAD, dtype=np.uint64)
+        padded[self.order - 1:] = data
+        target = padded[self.order - 1:]
+        shift = np.uint64(64 - self.bits)
+        context = np.zeros(n, dtype=np.uint64)
+        for k in range(self.order):
+            if k:
+                start = self.order - 1 - k
+                context = context * _PRIME + padded[start:start + n]
+            order_key = np.uint64((k + 1) * int(_MIX) % 2**64)
+            context_buckets = ((context + order_key) * _MIX) >> shift
+            ngram_buckets = ((context * _PRIME + target + order_key) * _NGRAM_SALT * _MIX) >> shift
+            yield k, context_buckets.astype(np.intp), ngram_buckets.astype(np.intp)
+
+    def fit(self, texts):
+        """
+        Adds the n-grams of `texts`, an iterable of strings, to the counts.
+        """
+        size = 1 << self.bits
+        for data in _byte_chunks(texts):
+            for k, context_buckets, ngram_buckets in self._buckets(data):
+                self.contexts[k] += np.bincount(context_buckets, minlength=size).astype(np.uint64)
+                self.ngrams[k] += np.bincount(ngram_buckets, minlength=size).astype(np.uint64)
+            self.trained_bytes += len(data)
+            count("bytes_read", len(data))
+        return self
+
+    def log_likelihood(self, data):
+        """
+        Natural log likelihood of `data`, an array of bytes.
+        """
+        p = np.zeros(len(data), dtype=np.float64)
+        for k, context_buckets, ngram_buckets in self._buckets(data):
+            p += self.weights[k] * (self.ngrams[k][ngram_buckets] + self.alpha) \
+                    / (self.contexts[k][context_buckets] + 256 * self.alpha)
+        return float(np.log(p).sum())
+
+    def perplexity(self, text):
+        """
+        Per byte perplexity of `text`. Long texts are scored in chunks of
+        `CHUNK_BYTES`, which only loses the context across chunk boundaries.
+        """
+        data = np.frombuffer(text.encode("utf-8", errors="replace"), dtype=np.uint8)
+        if not len(data):
+            return float("inf")
+        total = sum(self.log_likelihood(data[i:i + CHUNK_BYTES])
+                for i in range(0, len(data), CHUNK_BYTES))
+        return float(np.exp(-total / len(data)))
+
+    def save(self, path=MODEL_PATH):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, ngrams=self.ngrams, contexts=self.contexts,
+                weights=self.weights,
+                params=np.array([self.order, self.bits, self.alpha, self.trained_bytes,
+                    np.nan if self.threshold is None else self.threshold]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        with np.load(path) as f:
+            order, bits, alpha, trained_bytes, threshold = f["params"].tolist()
+            model = cls(int(order), int(bits), alpha, f["weights"])
+            model.ngrams = f["ngrams"]
+            model.contexts = f["contexts"]
+        model.trained_bytes = int(trained_bytes)
+        model.threshold = None if np.isnan(threshold) else threshold
+        return model
+
+
+def _byte_chunks(texts, size=CHUNK_BYTES):
+    """
+    Concatenates `texts` into byte arrays of about `size` bytes, texts
+    separated by blank lines.
+    """
+    buffer, buffered = [], 0
+    for text in texts:
+        encoded = text.encode("utf-8", errors="replace") + b"\n\n"
+        buffer.append(encoded)
+        buffered += len(encoded)
+        if buffered >= size:
+            yield np.frombuffer(b"".join(buffer), dtype=np.uint8)
+            buffer, buffered = [], 0
+    if buffer:
+        yield np.frombuffer(b"".join(buffer), dtype=np.uint8)
+
+
+def iter_texts(paths):
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                count("docs_in")
+                yield json.loads(line)["text"]
+
+
+def _expand(patterns):
+    return sorted(p for pattern in patterns for p in glob.glob(pattern))
+
+
+def train(path=MODEL_PATH, train_globs=TRAIN_GLOBS, val_globs=VAL_GLOBS, quantile=QUANTILE,
+        workers=None, **kwargs):
+    """
+    Trains a model on the reference train shards, sets its threshold from the
+    reference validation shards and saves it to `path`.
+    """
+    train_paths = _expand(train_globs)
+    if not train_paths:
+        raise FileNotFoundError(f"no reference shards match {', '.join(train_globs)}")
+    model = NgramModel(**kwargs)
+    with stage("train_noise_model"):
+        model.fit(iter_texts(train_paths))
+    print(f"trained on {model.trained_bytes / 2**20:.1f} MB from {len(train_paths)} shards")
+
+    val_paths = _expand(val_globs)
+    if val_paths:
+        with stage("calibrate_noise_model"):
+            perplexities = score(model, list(iter_texts(val_paths)), workers)
+        model.threshold = float(np.quantile(perplexities[np.isfinite(perplexities)], quantile))
+        print(f"threshold: perplexity {model.threshold:.3f}, the {quantile} quantile "
+                f"of {len(perplexities)} reference validation documents")
+    else:
+        print("no reference validation shards, the model has no threshold")
+    model.save(path)
+    return model
+
+
+# set in the parent before the pool forks, so that workers share the tables
+_model = None
+
+
+def _init_worker(path):
+    global _model
+    if _model is None:
+        _model = NgramModel.load(path)
+
+
+def _perplexity(text):
+    return _model.perplexity(text)
+
+
+def score(model, texts, workers=None, path=MODEL_PATH):
+    """
+    Perplexities of `texts`, as an array, computed in `workers` processes.
+    `path` is only read by workers that were not forked from this process.
+    """
+    global _model
+    _model = model
+    with Pool(workers or task_workers(), initializer=_init_worker, initargs=(path,)) as pool:
+        return np.fromiter(pool.imap(_perplexity, texts, chunksize=16), dtype=np.float64,
+                count=len(texts))
+
+
+def filter_noise(instances, path=MODEL_PATH, threshold=None, workers=None):
+    """
+    Writes each instance's perplexity into its parsed `meta` and returns the
+    instances at or below the threshold: `threshold`, else
+    `PROOF_PILE_NOISE_THRESHOLD`, else the model's own. Without a model the
+    instances are returned unscored.
+    """
+    if not os.path.exists(path):
+        print(f"WARNING: no noise model at {path}, not filtering noise. "
+                "Run `python noise_filter.py train` first.", file=sys.stderr)
+        return instances
+    model = NgramModel.load(path)
+    if threshold is None:
+        threshold = float(os.environ.get("PROOF_PILE_NOISE_THRESHOLD", "nan"))
+        if np.isnan(threshold):
+            threshold = model.threshold
+    if threshold is None:
+        raise ValueError(f"{path} has no threshold, set PROOF_PILE_NOISE_THRESHOLD")
+
+    perplexities = score(model, [x["text"] for x in instances], workers, path)
+    kept = []
+    for instance, perplexity in zip(instances, perplexities):
+        instance["meta"]["perplexity"] = round(float(perplexity), 4)
+        if perplexity <= threshold:
+            kept.append(instance)
+    reject("high_perplexity", len(instances) - len(kept))
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Byte n-gram noise scoring of arXiv documents.")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    c = commands.add_parser("train", help="train on the books and formal shards")
+    c.add_argument("--order", type=int, default=ORDER)
+    c.add_argument("--bits", type=int, default=BITS, help="log2 of the buckets per order")
+    c.add_argument("--quantile", type=float, default=QUANTILE,
+            help="of the validation perplexities, the threshold")
+
+    c = commands.add_parser("score", help="print the noisiest documents of jsonl files")
+    c.add_argument("paths", nargs="+")
+    c.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train(args.model, quantile=args.quantile, workers=args.workers,
+                order=args.order, bits=args.bits)
+    else:
+        model = NgramModel.load(args.model)
+        texts = list(iter_texts(args.paths))
+        perplexities = score(model, texts, args.workers, args.model)
+        print(f"median perplexity {np.median(perplexities):.3f}, threshold {model.threshold}")
+        for i in np.argsort(-perplexities)[:args.top]:
+            print(f"{perplexities[i]:10.3f}  {texts[i][:100]!r}")
+
+
+if __name__ == "__main__":
+    main()
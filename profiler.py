@@ -0,0 +1,203 @@
+"""
+Opt-in profiling of pipeline stages, for when an arXiv month or a Stack
+Exchange site is unexpectedly slow.
+
+    PROOF_PILE_PROFILE=process_tarball,questions python fetch_arxiv.py
+    PROOF_PILE_PROFILE='*_arxiv,parse_meta' python make_jsons.py
+    python build.py math_overflow --profile all
+
+`PROOF_PILE_PROFILE` is a comma separated list of stage names or fnmatch
+patterns, or "all". Every `metrics.stage` and every function decorated with
+`profile` can be selected. Each run of a selected stage writes to
+`PROFILE_DIR`, as `<stage>.<pid>.<n>` followed by:
+
+    .collapsed      stacks sampled by a background thread, one
+                    "frame;frame;frame count" line per stack, for
+                    flamegraph.pl or speedscope
+    .prof, .txt     cProfile stats of the thread that ran the stage, and
+                    the top functions by cumulative time
+    .memory.txt     the largest allocation sites seen by tracemalloc, at the
+                    end of the stage and at its sampled peak
+
+`PROOF_PILE_PROFILE_MODE` picks a subset of "sample,cprofile,memory". A stage
+nested in a profiled stage is accounted to the outer one. Stages that are not
+selected cost one environment lookup.
+"""
+import os
+import sys
+import time
+import itertools
+import threading
+import functools
+from fnmatch import fnmatch
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get("PROOF_PILE_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.environ.get("PROOF_PILE_PROFILE_INTERVAL", 0.01))
+MEMORY_INTERVAL = float(os.environ.get("PROOF_PILE_PROFILE_MEMORY_INTERVAL", 5))
+DEFAULT_MODE = "sample,cprofile,memory"
+
+# background threads of our own, which are never sampled
+_INTERNAL_THREADS = ("profiler-", "metrics-")
+
+_local = threading.local()
+_runs = itertools.count()
+
+
+def is_selected(name):
+    patterns = os.environ.get("PROOF_PILE_PROFILE", "")
+    if not patterns:
+        return False
+    for pattern in patterns.split(","):
+        pattern = pattern.strip()
+        if pattern in ("all", "*") or fnmatch(name, pattern) \
+                or fnmatch(name.rsplit("/", 1)[-1], pattern):
+            return True
+    return False
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    """
+    When `sample` is set, samples the stacks of every other thread every
+    `interval` seconds. When `memory` is set, keeps the tracemalloc snapshot
+    taken at the highest traced memory.
+    """
+    def __init__(self, interval, sample, memory):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = interval if sample else min(interval * 100, MEMORY_INTERVAL)
+        self.sample = sample
+        self.memory = memory
+        self.stacks = Counter()
+        self.peak = 0
+        self.peak_snapshot = None
+        self._done = threading.Event()
+
+    def run(self):
+        import tracemalloc
+
+        last_memory_check = 0
+        while not self._done.wait(self.interval):
+            if self.sample:
+                self._sample()
+
+            now = time.monotonic()
+            if self.memory and now - last_memory_check >= MEMORY_INTERVAL:
+                last_memory_check = now
+                current = tracemalloc.get_traced_memory()[0]
+                # snapshots are slow, only take one when memory has grown noticeably
+                if current > 1.1 * self.peak:
+                    self.peak = current
+                    self.peak_snapshot = tracemalloc.take_snapshot()
+
+    def _sample(self):
+        internal = {t.ident for t in threading.enumerate()
+                if t.name.startswith(_INTERNAL_THREADS)}
+        for ident, frame in sys._current_frames().items():
+            if ident in internal:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _write_memory_report(path, start, end, peak_snapshot, top=25):
+    import tracemalloc
+
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__))
+    with open(path, "w") as f:
+        current, peak = tracemalloc.get_traced_memory()
+        f.write(f"traced memory at the end: {current / 2**20:.1f} MB, "
+                f"peak: {peak / 2**20:.1f} MB\n\n")
+        f.write("largest allocation sites at the end of the stage, compared with its start\n")
+        for stat in end.filter_traces(ignore).compare_to(start.filter_traces(ignore),
+                "lineno")[:top]:
+            f.write(f"  {stat}\n")
+        if peak_snapshot is not None:
+            f.write("\nlargest allocation sites at the highest sampled memory\n")
+            for stat in peak_snapshot.filter_traces(ignore).statistics("lineno")[:top]:
+                f.write(f"  {stat}\n")
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profiles the enclosed block if `name` is selected by `PROOF_PILE_PROFILE`.
+    """
+    if getattr(_local, "active", False) or not is_selected(name):
+        yield
+        return
+
+    modes = {x.strip() for x in os.environ.get("PROOF_PILE_PROFILE_MODE", DEFAULT_MODE).split(",")}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR,
+            f"{name.replace('/', '.')}.{os.getpid()}.{next(_runs)}")
+
+    _local.active = True
+    tracemalloc = profile = sampler = None
+    started_tracing = False
+    try:
+        if "memory" in modes:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            start_snapshot = tracemalloc.take_snapshot()
+        if "sample" in modes or "memory" in modes:
+            sampler = _Sampler(PROFILE_INTERVAL, sample="sample" in modes,
+                    memory="memory" in modes)
+            sampler.start()
+        if "cprofile" in modes:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+        yield
+    finally:
+        _local.active = False
+        if profile is not None:
+            profile.disable()
+        if sampler is not None:
+            sampler.stop()
+        if tracemalloc is not None:
+            # before anything below allocates
+            end_snapshot = tracemalloc.take_snapshot()
+            _write_memory_report(prefix + ".memory.txt", start_snapshot, end_snapshot,
+                    sampler.peak_snapshot)
+            if started_tracing:
+                tracemalloc.stop()
+        if profile is not None:
+            import pstats
+            profile.dump_stats(prefix + ".prof")
+            with open(prefix + ".txt", "w") as f:
+                pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(40)
+        if sampler is not None and "sample" in modes:
+            with open(prefix + ".collapsed", "w") as f:
+                for stack, n in sampler.stacks.most_common():
+                    f.write(f"{stack} {n}\n")
+        print(f"profile of {name} written to {prefix}.*", file=sys.stderr)
+
+
+def profile(name=None):
+    """
+    Decorator form of `profiled`, `name` defaults to the function's name.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profiled(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
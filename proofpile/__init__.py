@@ -0,0 +1,3 @@
+"""
+Command line interface to the proof-pile build, see `proofpile.cli`.
+"""
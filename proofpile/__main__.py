@@ -0,0 +1,3 @@
+from proofpile.cli import main
+
+main()
@@ -0,0 +1,197 @@
+"""
+One entry point for every source and stage of the proof-pile build.
+
+    python -m proofpile --help
+    python -m proofpile books napkin stein --force
+    python -m proofpile stack-exchange math_overflow --delta
+    python -m proofpile noise train
+    python -m proofpile make-jsons validation
+    python -m proofpile startup          # import time of every module
+
+Run it from the root of the repository: outputs are written relative to the
+working directory. Only the standard library is imported up front. The
+module behind a subcommand, and with it its dependencies, is imported when
+the subcommand runs, and `--timing` prints how long that took.
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+
+_START = time.perf_counter()
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# sources, each a group of tasks in build.py
+SOURCES = {
+    "books": "textbooks and lecture notes",
+    "formal": "formal mathematics libraries",
+    "arxiv": "arXiv papers",
+    "stack-exchange": "Stack Exchange sites",
+    "wiki": "ProofWiki and Wikipedia",
+    "math-dataset": "the MATH dataset",
+}
+
+# modules whose import time `startup` reports
+MODULES = [
+    "utils", "metrics", "profiler", "cache", "download", "github_api", "gen_split",
+    "build", "fetch_books_and_formal", "fetch_arxiv", "fetch_stack_exchange",
+    "fetch_wiki", "fetch_math_dataset", "noise_filter", "make_jsons", "benchmark",
+]
+
+_timings = {}
+
+
+def _import(module_name):
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    _timings.setdefault(f"import {module_name}", time.perf_counter() - start)
+    return module
+
+
+def _creds():
+    return ("zhangir-azerbayev", os.environ.get("GITHUB_TOKEN"))
+
+
+def _run_source(args):
+    build = _import("build")
+    all_tasks = build.tasks(_creds())
+    group = [t for t in all_tasks if t.group == args.command]
+    names = {t.name for t in group}
+    for name in args.names:
+        if name not in names:
+            raise SystemExit(f"unknown {args.command} source {name}, "
+                    f"expected one of {', '.join(sorted(names))}")
+    if getattr(args, "delta", False):
+        for task in group:
+            task.kwargs["delta"] = True
+    if args.profile:
+        os.environ["PROOF_PILE_PROFILE"] = args.profile
+    targets = args.names or sorted(names)
+    # a delta run is for a dump that changed upstream, which the outputs of the
+    # last build don't show, so they must not count as up to date
+    force = args.force or getattr(args, "delta", False)
+    return build.build(all_tasks, targets, force=force, dry_run=args.dry_run)
+
+
+def _forward(module_name, prog):
+    """
+    A subcommand that hands the rest of the command line to `module_name`'s `main`.
+    """
+    def run(args):
+        sys.argv = [prog] + args.rest
+        _import(module_name).main()
+        return True
+    return run
+
+
+def _run_splits(args):
+    _import("gen_split").main()
+    return True
+
+
+def _run_make_jsons(args):
+    make_jsons = _import("make_jsons")
+    start = time.time()
+    for split in args.splits or ["train", "validation"]:
+        make_jsons.main(split)
+    _import("metrics").print_summary(since=start)
+    return True
+
+
+def _run_metrics(args):
+    metrics = _import("metrics")
+    metrics.print_summary(args.log or metrics.METRICS_PATH)
+    return True
+
+
+def _run_startup(args):
+    """
+    Imports every module in a fresh interpreter, as a worker process would.
+    """
+    code = ("import sys, time; t = time.perf_counter(); import {}; "
+            "sys.stdout.write(str(time.perf_counter() - t))")
+    print(f"{'module':<28} {'import ms':>10}")
+    for module_name in MODULES:
+        proc = subprocess.run([sys.executable, "-c", code.format(module_name)],
+                cwd=REPO_DIR, capture_output=True, text=True)
+        if proc.returncode == 0:
+            print(f"{module_name:<28} {1000 * float(proc.stdout):>10.1f}")
+        else:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"
+            print(f"{module_name:<28} {'-':>10}  {error}")
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "proofpile", "--help"], cwd=REPO_DIR,
+            capture_output=True, check=True)
+    print(f"\n`proofpile --help` end to end: {1000 * (time.perf_counter() - start):.1f} ms")
+    return True
+
+
+def parser():
+    p = argparse.ArgumentParser(prog="proofpile", description="Build the proof-pile.")
+    p.add_argument("--timing", action="store_true",
+            help="print how long startup and imports took")
+    commands = p.add_subparsers(dest="command", required=True, metavar="COMMAND")
+
+    for name, description in SOURCES.items():
+        c = commands.add_parser(name, help=f"fetch {description}")
+        c.add_argument("names", nargs="*", help="sources to fetch, defaults to all")
+        c.add_argument("--force", action="store_true", help="refetch up to date sources")
+        c.add_argument("--dry-run", action="store_true")
+        c.add_argument("--profile", metavar="STAGES", default=None,
+                help="comma separated stages to profile, or 'all'")
+        if name == "stack-exchange":
+            c.add_argument("--delta", action="store_true",
+                    help="only re-render questions changed since the last build")
+        c.set_defaults(run=_run_source)
+
+    c = commands.add_parser("build", help="everything, or the given tasks, see build.py",
+            add_help=False)
+    c.set_defaults(run=_forward("build", "proofpile build"), forward=True)
+
+    c = commands.add_parser("splits", help="write splits.json and splits.idx")
+    c.set_defaults(run=_run_splits)
+
+    c = commands.add_parser("noise", help="train or run the arXiv noise scorer, see noise_filter.py",
+            add_help=False)
+    c.set_defaults(run=_forward("noise_filter", "proofpile noise"), forward=True)
+
+    c = commands.add_parser("make-jsons", help="assemble the final shards")
+    c.add_argument("splits", nargs="*", choices=["train", "validation"], metavar="SPLIT",
+            help="train or validation, defaults to both")
+    c.set_defaults(run=_run_make_jsons)
+
+    c = commands.add_parser("benchmark", help="time the hot paths, see benchmark.py",
+            add_help=False)
+    c.set_defaults(run=_forward("benchmark", "proofpile benchmark"), forward=True)
+
+    c = commands.add_parser("metrics", help="summarize a metrics log")
+    c.add_argument("log", nargs="?", default=None)
+    c.set_defaults(run=_run_metrics)
+
+    c = commands.add_parser("startup", help="measure the import time of every module")
+    c.set_defaults(run=_run_startup)
+    return p
+
+
+def main(argv=None):
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    p = parser()
+    args, rest = p.parse_known_args(argv)
+    if getattr(args, "forward", False):
+        # parsed by the module's own main
+        args.rest = rest
+    elif rest:
+        p.error(f"unrecognized arguments: {' '.join(rest)}")
+    _timings["startup"] = time.perf_counter() - _START
+    try:
+        ok = args.run(args)
+    finally:
+        if args.timing:
+            for name, seconds in _timings.items():
+                print(f"{name}: {1000 * seconds:.1f} ms", file=sys.stderr)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,107 @@
+"""
+Shared fixtures. `http_server` runs a local stand-in for the remote APIs the
+fetchers talk to, so they can be tested without the network.
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+# counters of the code under test are not interesting here
+os.environ.setdefault("PROOF_PILE_METRICS", os.devnull)
+
+
+class LocalServer:
+    """
+    Answers every GET with `respond(request)`, which returns `(status,
+    headers, body)`. If `body` is shorter than a Content-Length given in
+    `headers`, the connection is closed after it, like a dropped download.
+    Every request is recorded as `(path, headers)` in `requests`.
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                status, headers, body = server.respond(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if "Content-Length" not in headers:
+                    self.send_header("Content-Length", str(len(body)))
+                elif int(headers["Content-Length"]) != len(body):
+                    self.close_connection = True
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def http_server():
+    """
+    `http_server(respond)` starts a `LocalServer`, which is stopped after the test.
+    """
+    servers = []
+
+    def start(respond):
+        servers.append(LocalServer(respond))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Records the delays passed to `time.sleep` instead of sleeping.
+    """
+    delays = []
+    monkeypatch.setattr("time.sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def in_process(monkeypatch, tmp_path):
+    """
+    Runs build.py's tasks in threads of this process, so that they see the
+    test's patches, with the build's outputs under `tmp_path`. The widths of
+    the pools are recorded in the returned list.
+    """
+    import build
+
+    widths = []
+
+    def pool(workers, **kwargs):
+        widths.append(workers)
+        return ThreadPoolExecutor(workers)
+
+    monkeypatch.setattr(build, "ProcessPoolExecutor", pool)
+    monkeypatch.chdir(tmp_path)
+    # set by the build for its workers, restored after the test
+    for name in ("PROOF_PILE_RUN_START", "PROOF_PILE_WORKERS"):
+        monkeypatch.setenv(name, "")
+    return widths
@@ -0,0 +1,36 @@
+import os
+import threading
+
+import build
+from build import Task
+
+_lock = threading.Lock()
+_running = [0, 0]  # now, peak
+
+
+def _hold(seconds):
+    with _lock:
+        _running[0] += 1
+        _running[1] = max(_running[1], _running[0])
+    threading.Event().wait(seconds)
+    with _lock:
+        _running[0] -= 1
+
+
+def test_memory_heavy_tasks_run_two_at_a_time(in_process):
+    _running[:] = [0, 0]
+    tasks = [Task(f"site{i}", f"{__name__}:_hold", args=(0.05,), kind="mem") for i in range(5)]
+
+    assert build.build(tasks)
+
+    assert _running[1] == 2
+    assert all(os.path.exists(t.stamp) for t in tasks)
+
+
+def test_cpu_tasks_share_the_cpus(in_process, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 16)
+    assert build.build([Task("a", f"{__name__}:_hold", args=(0,), kind="cpu")])
+
+    # io, cpu and mem pools
+    assert in_process == [8, 4, 2]
+    assert os.environ["PROOF_PILE_WORKERS"] == "4"
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import fetch_stack_exchange
+from proofpile import cli
+
+
+def _record_calls(monkeypatch):
+    """
+    Replaces `get_and_format` with one that writes empty shards and records
+    its `(save_dir, delta)` arguments in the returned list.
+    """
+    calls = []
+
+    def get_and_format(url, save_dir, delta=False):
+        calls.append((save_dir, delta))
+        os.makedirs(save_dir, exist_ok=True)
+        for name in ("train.jsonl.gz", "val.jsonl.gz"):
+            open(os.path.join(save_dir, name), "w").close()
+
+    monkeypatch.setattr(fetch_stack_exchange, "get_and_format", get_and_format)
+    return calls
+
+
+def test_delta_run_refetches_up_to_date_site(monkeypatch, in_process):
+    calls = _record_calls(monkeypatch)
+    site_dir = os.path.join("stack-exchange", "math_overflow")
+
+    for _ in range(2):
+        with pytest.raises(SystemExit) as exit:
+            cli.main(["stack-exchange", "math_overflow", "--delta"])
+        assert exit.value.code == 0
+
+    assert calls == [(site_dir, True), (site_dir, True)]
+
+
+def test_plain_run_skips_up_to_date_site(monkeypatch, in_process):
+    calls = _record_calls(monkeypatch)
+
+    for _ in range(2):
+        with pytest.raises(SystemExit):
+            cli.main(["stack-exchange", "math_overflow"])
+
+    assert len(calls) == 1
@@ -0,0 +1,92 @@
+import hashlib
+import re
+
+import pytest
+
+from download import download
+
+DATA = bytes(range(256)) * 4096  # 1 MiB
+
+
+def _ranged(request, data=DATA, drop_after=None):
+    """
+    Serves `data`, honoring a "bytes=<start>-" Range header. With
+    `drop_after`, a full response is cut off after that many bytes.
+    """
+    match = re.fullmatch(r"bytes=(\d+)-", request.headers.get("Range", ""))
+    if match:
+        start = int(match.group(1))
+        if start >= len(data):
+            return 416, {"Content-Range": f"bytes */{len(data)}"}, b""
+        return 206, {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"}, data[start:]
+    body = data if drop_after is None else data[:drop_after]
+    return 200, {"Content-Length": str(len(data))}, body
+
+
+def test_asks_for_unencoded_content(http_server, tmp_path):
+    server = http_server(_ranged)
+    dest = download(server.url + "/f", str(tmp_path / "f"))
+
+    assert open(dest, "rb").read() == DATA
+    assert server.requests[0][1]["Accept-Encoding"] == "identity"
+
+
+def test_resumes_dropped_connection_with_range(http_server, tmp_path, sleeps):
+    dropped = []
+
+    def respond(request):
+        if not dropped:
+            dropped.append(True)
+            return _ranged(request, drop_after=300_000)
+        return _ranged(request)
+
+    server = http_server(respond)
+    dest = download(server.url + "/f", str(tmp_path / "f"), chunk_size=1 << 16)
+
+    assert open(dest, "rb").read() == DATA
+    assert len(server.requests) == 2
+    assert "Range" not in server.requests[0][1]
+    offset = int(re.fullmatch(r"bytes=(\d+)-", server.requests[1][1]["Range"]).group(1))
+    assert 0 < offset <= 300_000
+
+
+def test_resumes_part_file_of_earlier_run(http_server, tmp_path):
+    server = http_server(_ranged)
+    (tmp_path / "f.part").write_bytes(DATA[:1000])
+
+    dest = download(server.url + "/f", str(tmp_path / "f"),
+            sha256=hashlib.sha256(DATA).hexdigest())
+
+    assert open(dest, "rb").read() == DATA
+    assert server.requests[0][1]["Range"] == "bytes=1000-"
+
+
+def test_416_accepts_complete_part_file(http_server, tmp_path):
+    server = http_server(_ranged)
+    (tmp_path / "f.part").write_bytes(DATA)
+
+    dest = download(server.url + "/f", str(tmp_path / "f"))
+
+    assert open(dest, "rb").read() == DATA
+    assert not (tmp_path / "f.part").exists()
+    assert len(server.requests) == 1
+
+
+def test_416_with_oversized_part_file_starts_over(http_server, tmp_path, sleeps):
+    server = http_server(_ranged)
+    (tmp_path / "f.part").write_bytes(DATA + b"stale tail")
+
+    dest = download(server.url + "/f", str(tmp_path / "f"))
+
+    assert open(dest, "rb").read() == DATA
+    assert len(server.requests) == 2
+    assert "Range" not in server.requests[1][1]
+
+
+def test_sha256_mismatch_is_rejected(http_server, tmp_path):
+    server = http_server(_ranged)
+
+    with pytest.raises(AssertionError, match="sha256"):
+        download(server.url + "/f", str(tmp_path / "f"), sha256="0" * 64)
+    assert not (tmp_path / "f").exists()
+    assert not (tmp_path / "f.part").exists()
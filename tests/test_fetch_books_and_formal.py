@@ -0,0 +1,94 @@
+import functools
+import gzip
+import json
+import re
+
+import pytest
+
+import fetch_books_and_formal
+from fetch_books_and_formal import JsonlSplitSink, _CHUNK_BOUNDARIES, chunks_of_lines
+
+
+@pytest.mark.parametrize("ext, line", [
+    (".lean", "theorem foo : 1 = 1 := rfl\n"),
+    (".lean", "/-- The foo -/\n"),
+    (".lean", "@[simp] lemma foo : 1 = 1 := rfl\n"),
+    (".lean", "protected lemma foo : 1 = 1 := rfl\n"),
+    (".lean", "private noncomputable def bar := 0\n"),
+    (".lean", "  def baz := 0\n"),
+    (".mm", "$( Section header\n"),
+    (".mm", "  $( The foo theorem. $)\n"),
+    (".v", "Local Definition x := 0.\n"),
+    (".v", "(** Docs *)\n"),
+    (".thy", "private lemma foo: True\n"),
+    (".tex", "  \\section*{Intro}\n"),
+])
+def test_boundaries(ext, line):
+    assert re.match(_CHUNK_BOUNDARIES[ext], line)
+
+
+@pytest.mark.parametrize("ext, line", [
+    (".lean", "definitely not\n"),
+    (".lean", "lemmas := foo\n"),
+    (".lean", "  exact foo\n"),
+    (".mm", "  foo $p |- ph $.\n"),
+    (".v", "Theorems about x.\n"),
+    (".ml", "  let x = 1 in\n"),
+])
+def test_non_boundaries(ext, line):
+    assert not re.match(_CHUNK_BOUNDARIES[ext], line)
+
+
+def _lemmas(n):
+    # each lemma is a boundary line and a 9 character proof line
+    return [line for i in range(n) for line in (f"lemma l{i} :\n", "  := rfl\n")]
+
+
+def test_chunk_ends_at_boundary_after_max_chars():
+    lines = _lemmas(4)
+
+    chunks = list(chunks_of_lines(lines, "a.lean", max_chars=30))
+
+    # 10 + 9 + 10 + 9 characters reach 30 inside the second lemma
+    assert [(first, last) for _, first, last in chunks] == [(1, 4), (5, 8)]
+    assert "".join(text for text, _, _ in chunks) == "".join(lines)
+
+
+def test_chunk_without_boundary_is_cut_at_twice_max_chars():
+    lines = ["  := rfl\n"] * 10
+
+    chunks = list(chunks_of_lines(lines, "a.lean", max_chars=20))
+
+    # cut once 40 characters are reached, after the 5th line
+    assert [(first, last) for _, first, last in chunks] == [(1, 5), (6, 10)]
+
+
+def _read(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+def _write_lines(tmp_path, monkeypatch, path, lines, max_chars):
+    # no split index here, so the file is assigned by hash
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fetch_books_and_formal, "chunks_of_lines",
+            functools.partial(chunks_of_lines, max_chars=max_chars))
+    with JsonlSplitSink("train.jsonl", "val.jsonl", "lean-train", "lean-valid") as sink:
+        sink.write_lines(path, lines)
+    return _read(tmp_path / "train.jsonl.gz") + _read(tmp_path / "val.jsonl.gz")
+
+
+def test_write_lines_names_chunks_by_line_range(tmp_path, monkeypatch):
+    docs = _write_lines(tmp_path, monkeypatch, "formal/lean/a.lean", _lemmas(6), 30)
+
+    assert [(d["meta"]["chunk"], d["meta"]["lines"]) for d in docs] == \
+            [(0, [1, 4]), (1, [5, 8]), (2, [9, 12])]
+    assert {d["meta"]["file"] for d in docs} == {"formal/lean/a.lean"}
+
+
+def test_write_lines_keeps_short_file_whole(tmp_path, monkeypatch):
+    docs = _write_lines(tmp_path, monkeypatch, "formal/lean/a.lean", _lemmas(2), 1000)
+
+    assert len(docs) == 1
+    assert docs[0]["text"] == "".join(_lemmas(2))
+    assert "chunk" not in docs[0]["meta"] and "lines" not in docs[0]["meta"]
@@ -0,0 +1,46 @@
+import os
+import subprocess
+
+import pytest
+
+from fetch_stack_exchange import open_archive_member
+
+
+@pytest.fixture
+def fake_7z(tmp_path, monkeypatch):
+    """
+    `fake_7z(script)` puts a `7z` running the shell `script` first on the PATH.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def install(script):
+        path = bin_dir / "7z"
+        path.write_text("#!/bin/sh\n" + script)
+        path.chmod(0o755)
+    return install
+
+
+def test_reads_member(fake_7z):
+    fake_7z("printf '<posts/>'\n")
+
+    with open_archive_member("a.7z", "Posts.xml") as f:
+        assert f.read() == b"<posts/>"
+
+
+def test_failed_extraction_raises(fake_7z):
+    fake_7z("printf '<posts>'; exit 2\n")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with open_archive_member("a.7z", "Posts.xml") as f:
+            f.read()
+
+
+def test_stopping_early_kills_7z(fake_7z):
+    fake_7z("while true; do echo '<row/>'; done\n")
+
+    with pytest.raises(ValueError, match="enough"):
+        with open_archive_member("a.7z", "Posts.xml") as f:
+            f.readline()
+            raise ValueError("read enough")
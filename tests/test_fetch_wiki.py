@@ -0,0 +1,94 @@
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+
+from fetch_wiki import CategoryCrawler
+
+# A -> B -> C -> D, with B -> A closing a cycle
+GRAPH = {
+    "Category:A": (["Page a"], ["Category:B"]),
+    "Category:B": (["Page b", "Page shared"], ["Category:A", "Category:C"]),
+    "Category:C": (["Page c", "Page shared"], ["Category:D"]),
+    "Category:D": (["Page d"], []),
+}
+
+
+def _mediawiki(request):
+    """
+    `categorymembers` over `GRAPH`, one member per response, continued with
+    `cmcontinue` like the real API.
+    """
+    params = {k: v[0] for k, v in parse_qs(urlparse(request.path).query).items()}
+    pages, subcats = GRAPH[params["cmtitle"]]
+    members = [{"ns": 0, "title": x} for x in pages] + [{"ns": 14, "title": x} for x in subcats]
+    i = int(params.get("cmcontinue", 0))
+    data = {"query": {"categorymembers": members[i:i + 1]}}
+    if i + 1 < len(members):
+        data["continue"] = {"cmcontinue": str(i + 1), "continue": "-||"}
+    return 200, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+
+def _fetched(server):
+    return [parse_qs(urlparse(path).query)["cmtitle"][0] for path, _ in server.requests]
+
+
+def _crawler(server, tmp_path, **kwargs):
+    return CategoryCrawler(api_url=server.url + "/w/api.php",
+            cache_dir=str(tmp_path / "cache"), **kwargs)
+
+
+def test_crawl_visits_each_category_once_despite_cycle(http_server, tmp_path):
+    server = http_server(_mediawiki)
+
+    titles = _crawler(server, tmp_path).crawl(["Category:A"])
+
+    assert titles == {"Page a", "Page b", "Page c", "Page d", "Page shared"}
+    # one request per member, as the server pages one member at a time
+    fetched = _fetched(server)
+    assert sorted(set(fetched)) == sorted(GRAPH)
+    assert len(fetched) == sum(len(p) + len(s) for p, s in GRAPH.values())
+
+
+def test_crawl_stops_at_max_depth(http_server, tmp_path):
+    server = http_server(_mediawiki)
+
+    titles = _crawler(server, tmp_path, max_depth=1).crawl(["Category:A"])
+
+    assert titles == {"Page a", "Page b", "Page shared"}
+    assert set(_fetched(server)) == {"Category:A", "Category:B"}
+
+
+def test_members_are_served_from_cache_within_ttl(http_server, tmp_path):
+    server = http_server(_mediawiki)
+    _crawler(server, tmp_path).crawl(["Category:A"])
+    n = len(server.requests)
+
+    assert _crawler(server, tmp_path).crawl(["Category:A"]) == \
+            {"Page a", "Page b", "Page c", "Page d", "Page shared"}
+    assert len(server.requests) == n
+
+
+def test_expired_members_are_fetched_again(http_server, tmp_path):
+    server = http_server(_mediawiki)
+    crawler = _crawler(server, tmp_path, ttl=60)
+    crawler.members("Category:D")
+    past = time.time() - 120
+    os.utime(crawler._cache_path("Category:D"), (past, past))
+
+    assert crawler.members("Category:D") == (["Page d"], [])
+    assert _fetched(server) == ["Category:D", "Category:D"]
+
+
+def test_evict_removes_only_expired_entries(http_server, tmp_path):
+    server = http_server(_mediawiki)
+    crawler = _crawler(server, tmp_path, ttl=60)
+    crawler.members("Category:C")
+    crawler.members("Category:D")
+    past = time.time() - 120
+    os.utime(crawler._cache_path("Category:D"), (past, past))
+
+    crawler.evict()
+
+    assert os.path.exists(crawler._cache_path("Category:C"))
+    assert not os.path.exists(crawler._cache_path("Category:D"))
@@ -0,0 +1,168 @@
+import base64
+import json
+import re
+import threading
+import time
+
+import pytest
+
+from github_api import GithubFetcher
+
+
+def _json(data, status=200, **headers):
+    return status, {"Content-Type": "application/json", **headers}, json.dumps(data).encode()
+
+
+def _fetcher(server, **kwargs):
+    return GithubFetcher(api_url=server.url, cache=False, backoff=0.5, **kwargs)
+
+
+def test_retries_server_errors_with_backoff(http_server, sleeps):
+    responses = iter([_json({}, 502), _json({}, 503), _json({"ok": True})])
+    server = http_server(lambda request: next(responses))
+
+    assert _fetcher(server).get_json("/repos/a/b") == {"ok": True}
+    assert len(server.requests) == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_gives_up_after_retries(http_server, sleeps):
+    server = http_server(lambda request: _json({}, 500))
+
+    with pytest.raises(AssertionError, match="500"):
+        _fetcher(server, retries=2).get_json("/repos/a/b")
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(http_server, sleeps):
+    server = http_server(lambda request: _json({"message": "Not Found"}, 404))
+
+    with pytest.raises(AssertionError, match="404"):
+        _fetcher(server).get_json("/repos/a/b")
+    assert len(server.requests) == 1
+    assert sleeps == []
+
+
+def test_retry_after_is_honored(http_server, sleeps):
+    responses = iter([_json({}, 429, **{"Retry-After": "7"}), _json({"ok": True})])
+    server = http_server(lambda request: next(responses))
+
+    assert _fetcher(server).get_json("/repos/a/b") == {"ok": True}
+    assert sleeps == [7.0]
+
+
+def test_exhausted_rate_limit_waits_for_reset(http_server, sleeps):
+    reset_at = time.time() + 30
+    limited = _json({"message": "API rate limit exceeded"}, 403, **{
+        "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset_at)})
+    responses = iter([limited, _json({"ok": True})])
+    server = http_server(lambda request: next(responses))
+
+    assert _fetcher(server, min_remaining=0).get_json("/repos/a/b") == {"ok": True}
+    # until the window resets, plus a second of slack
+    assert len(sleeps) == 1 and 29 < sleeps[0] <= 31
+
+
+def test_low_rate_limit_spreads_requests(http_server, sleeps):
+    reset_at = time.time() + 100
+    server = http_server(lambda request: _json({"ok": True}, **{
+        "X-RateLimit-Remaining": "10", "X-RateLimit-Reset": str(reset_at)}))
+    fetcher = _fetcher(server, min_remaining=100)
+
+    fetcher.get_json("/repos/a/b")
+    assert sleeps == []
+    fetcher.get_json("/repos/a/b")
+    # the 100 seconds left in the window, shared by the 10 requests left
+    assert len(sleeps) == 1 and 9 < sleeps[0] <= 10
+
+
+def test_unanswered_request_is_retried(http_server, sleeps):
+    answered = threading.Event()
+
+    def respond(request):
+        if not answered.is_set():
+            answered.set()
+            # outlasts the timeout, not patched by `sleeps`
+            threading.Event().wait(1.0)
+        return _json({"ok": True})
+
+    server = http_server(respond)
+
+    assert _fetcher(server, timeout=0.2).get_json("/repos/a/b") == {"ok": True}
+    assert len(server.requests) == 2
+    assert sleeps == [0.5]
+
+
+# long enough that their base64 spans several lines
+BLOBS = {f"b{i}": f"file {i}\n".encode() * 20 * (i + 1) for i in range(4)}
+# three files and a subdirectory holding one more
+TREES = {
+    "root": [
+        {"path": "a.lean", "type": "blob", "sha": "b0"},
+        {"path": "b.lean", "type": "blob", "sha": "b1"},
+        {"path": "c.lean", "type": "blob", "sha": "b2"},
+        {"path": "src", "type": "tree", "sha": "sub"},
+    ],
+    "sub": [{"path": "d.lean", "type": "blob", "sha": "b3"}],
+}
+
+
+def _git_api(http_server, hold=None):
+    """
+    Serves the trees and blobs API over `TREES` and `BLOBS`. Blob contents are
+    base64 with line breaks, like Github's. With `hold`, each blob response
+    waits that long. The most blob requests seen open at once is counted in
+    `peak[0]`.
+    """
+    lock = threading.Lock()
+    open_now, peak = [0], [0]
+
+    def respond(request):
+        kind, sha = re.fullmatch(r"/repos/a/b/git/(trees|blobs)/(\w+)", request.path).groups()
+        if kind == "trees":
+            base = f"http://{request.headers['Host']}/repos/a/b/git"
+            tree = [{**x, "url": f"{base}/{x['type']}s/{x['sha']}"} for x in TREES[sha]]
+            return _json({"sha": sha, "tree": tree})
+        with lock:
+            open_now[0] += 1
+            peak[0] = max(peak[0], open_now[0])
+        if hold:
+            threading.Event().wait(hold)
+        with lock:
+            open_now[0] -= 1
+        content = base64.encodebytes(BLOBS[sha]).decode()
+        return _json({"sha": sha, "encoding": "base64", "content": content})
+
+    return http_server(respond), peak
+
+
+def test_tree_and_subtree(http_server):
+    server, _ = _git_api(http_server)
+    fetcher = _fetcher(server)
+
+    tree = fetcher.tree("a", "b", "root")
+    assert [x["path"] for x in tree] == ["a.lean", "b.lean", "c.lean", "src"]
+    subtree = fetcher.subtree(tree[3])
+    assert [(x["path"], x["sha"]) for x in subtree] == [("d.lean", "b3")]
+
+
+def test_blob_is_decoded(http_server):
+    server, _ = _git_api(http_server)
+    fetcher = _fetcher(server)
+
+    entry = fetcher.subtree(fetcher.tree("a", "b", "root")[3])[0]
+    assert fetcher.blob(entry) == BLOBS["b3"]
+
+
+def test_blobs_keep_order_and_cap_requests_in_flight(http_server):
+    server, peak = _git_api(http_server, hold=0.05)
+    fetcher = _fetcher(server, max_in_flight=2)
+    tree = fetcher.tree("a", "b", "root")
+    # many entries, some repeated, so that the fetches overlap
+    entries = [x for x in tree if x["type"] == "blob"] * 4
+
+    pairs = list(fetcher.blobs(entries))
+
+    assert [entry for entry, _ in pairs] == entries
+    assert [contents for _, contents in pairs] == [BLOBS[x["sha"]] for x in entries]
+    assert peak[0] == 2
@@ -0,0 +1,69 @@
+import gzip
+import os
+import random
+import tarfile
+import zlib
+
+from utils import ParallelGzipWriter, make_archive
+
+
+def _files(n=6, size=150_000):
+    # incompressible, so that the archive spans many blocks
+    rng = random.Random(0)
+    return {f"f{i}.tex": rng.randbytes(size) for i in range(n)}
+
+
+def test_parallel_gzip_is_a_single_stream(tmp_path):
+    data = b"".join(_files().values())
+    path = str(tmp_path / "x.gz")
+    with ParallelGzipWriter(path, threads=4, block_size=1 << 16) as f:
+        f.write(data)
+
+    assert gzip.decompress(open(path, "rb").read()) == data
+    # one member: nothing follows the first member's trailer
+    with open(path, "rb") as raw:
+        d = zlib.decompressobj(31)
+        assert d.decompress(raw.read()) == data
+        assert d.eof and d.unused_data == b""
+
+
+def test_empty_parallel_gzip(tmp_path):
+    path = str(tmp_path / "x.gz")
+    ParallelGzipWriter(path).close()
+
+    assert gzip.decompress(open(path, "rb").read()) == b""
+
+
+def test_archive_spanning_blocks_reads_in_stream_mode(tmp_path):
+    files = _files()
+    path = str(tmp_path / "0901")
+    os.mkdir(path)
+    for name, data in files.items():
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(data)
+
+    with ParallelGzipWriter(path + ".tar.gz", threads=4, block_size=1 << 16) as f:
+        with tarfile.open(fileobj=f, mode="w|") as tar:
+            tar.add(path, arcname=os.path.sep)
+
+    # the mode `datasets`' iter_archive reads archives in
+    read = {}
+    with open(path + ".tar.gz", "rb") as f, tarfile.open(fileobj=f, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                read[os.path.basename(member.name)] = tar.extractfile(member).read()
+    assert read == files
+
+
+def test_make_archive(tmp_path):
+    path = str(tmp_path / "0902")
+    os.mkdir(path)
+    with open(os.path.join(path, "a.tex"), "w") as f:
+        f.write("\\section{A}")
+
+    make_archive(path)
+
+    assert not os.path.exists(path)
+    with tarfile.open(path + ".tar.gz", mode="r|*") as tar:
+        names = [os.path.basename(m.name) for m in tar if m.isfile()]
+    assert names == ["a.tex"]
@@ -1,53 +1,457 @@
 import os
+import re
+import gzip
+import hashlib
+import json
+import shutil
+import struct
 import tarfile 
-from itertools import cycle
-from shutil import get_terminal_size
-from threading import Thread
-from time import sleep
-
-def make_archive(path): 
-    with tarfile.open(path + ".tar.gz", "w:gz") as tar: 
-        tar.add(path, arcname=os.path.sep)
-    os.system(f"rm -r {path}")
-
-class Loader:
-    def __init__(self, desc="Loading...", end="Done!", timeout=0.1):
-        """
-        A loader-like context manager
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from metrics import count
+
+
+def task_workers():
+    """
+    How many processes or threads a task's own CPU-bound pools use: all CPUs,
+    unless build.py, which runs several tasks at once, shares them out in
+    `PROOF_PILE_WORKERS`.
+    """
+    return int(os.environ.get("PROOF_PILE_WORKERS", 0)) or os.cpu_count()
 
-        Args:
-            desc (str, optional): The loader's description. Defaults to "Loading...".
-            end (str, optional): Final print. Defaults to "Done!".
-            timeout (float, optional): Sleep time between prints. Defaults to 0.1.
-        """
-        self.desc = desc
-        self.end = end
-        self.timeout = timeout
 
-        self._thread = Thread(target=self._animate, daemon=True)
-        self.steps = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
-        self.done = False
+class ParallelGzipWriter:
+    """
+    pigz-style gzip: input is cut into `block_size` blocks that are deflated
+    concurrently, each primed with the last 32 KiB of the block before it.
+    Every block but the last ends in a sync flush, so the blocks concatenate
+    into a single deflate stream, behind one gzip header and one trailer.
+    This matters for readers like `tarfile`'s stream mode, which `datasets`
+    uses, that stop at the end of the first gzip member. zlib releases the GIL
+    while compressing, so threads use every core.
+    """
+    def __init__(self, path, level=6, threads=None, block_size=1 << 24):
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or task_workers()
+        self._f = open(path, "wb")
+        # no file name, no mtime, so archives of the same input are identical
+        self._f.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+        self._executor = ThreadPoolExecutor(self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
 
-    def start(self):
-        self._thread.start()
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]), last=False)
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block, last):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._executor.submit(_deflate_block, block, self.level,
+                self._dictionary, last))
+        self._dictionary = block[-(1 << 15):]
+        # bound memory to a couple of blocks per thread
+        while len(self._pending) > 2 * self.threads:
+            self._f.write(self._pending.popleft().result())
+
+    def close(self):
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        while self._pending:
+            self._f.write(self._pending.popleft().result())
+        self._f.write(struct.pack("<II", self._crc, self._size & 0xffffffff))
+        self._executor.shutdown()
+        self._f.close()
+
+    def __enter__(self):
         return self
 
-    def _animate(self):
-        for c in cycle(self.steps):
-            if self.done:
-                break
-            print(f"\r{self.desc} {c}", flush=True, end="")
-            sleep(self.timeout)
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _deflate_block(block, level, dictionary, last):
+    """
+    Raw deflate of one block of a `ParallelGzipWriter` stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def open_compressed(path, codec="gz", level=None, threads=None):
+    """
+    A writable binary file object that compresses into `path`. `codec` is "gz"
+    (block-parallel, see `ParallelGzipWriter`) or "zst", which needs the
+    `zstandard` package.
+    """
+    if codec == "gz":
+        return ParallelGzipWriter(path, level=6 if level is None else level, threads=threads)
+    elif codec == "zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression needs `pip install zstandard`")
+        cctx = zstandard.ZstdCompressor(
+            level=3 if level is None else level, threads=threads or task_workers()
+        )
+        return cctx.stream_writer(open(path, "wb"), closefd=True)
+    else:
+        raise ValueError(f"unknown codec {codec}")
+
+
+def remove_tree(path):
+    """
+    `rm -r`, in process. Refuses to touch the filesystem root, the home
+    directory, or the working directory and its parents.
+    """
+    real = os.path.realpath(path)
+    protected = {os.path.realpath(os.sep), os.path.realpath(os.path.expanduser("~"))}
+    if real in protected or os.getcwd().startswith(real.rstrip(os.sep) + os.sep) \
+            or real == os.getcwd():
+        raise ValueError(f"refusing to delete {path}")
+
+    def make_writable_and_retry(fn, p, exc_info):
+        # arXiv sources sometimes unpack read-only
+        os.chmod(os.path.dirname(p), 0o755)
+        if os.path.exists(p):
+            os.chmod(p, 0o755)
+        fn(p)
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, onerror=make_writable_and_retry)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def make_archive(path, codec="gz", level=None, threads=None): 
+    """
+    Tars `path` into `path + ".tar." + codec`, then deletes `path`.
+    """
+    with open_compressed(path + ".tar." + codec, codec, level, threads) as f: 
+        with tarfile.open(fileobj=f, mode="w|") as tar: 
+            tar.add(path, arcname=os.path.sep)
+    remove_tree(path)
+
+def _utf8_dir_path(dir_path):
+    """
+    Renames the directory `dir_path` if its name is not valid UTF-8, replacing
+    the offending bytes, so that paths of the files below it can be printed
+    and written back. Returns the new path.
+    """
+    try:
+        dir_path.encode("utf-8")
+        return dir_path
+    except UnicodeEncodeError:
+        new_path = dir_path.encode("utf-8", "replace").decode()
+        while os.path.exists(new_path):
+            new_path += "_"
+        os.rename(dir_path, new_path)
+        return new_path
+
+
+def walk_files(path, fix_dir_names=False):
+    """
+    Yields an `os.DirEntry` for every non-directory under `path`, symlinks
+    included. Iterative, and the entries carry the file type from `os.scandir`,
+    so no extra stat calls are made. With `fix_dir_names`, directories whose
+    names are not valid UTF-8 are renamed before they are walked.
+    """
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(_utf8_dir_path(entry.path) if fix_dir_names else entry.path)
+                else:
+                    yield entry
+
+
+def prune_tree(path, pattern, transform=None, workers=0, processes=False):
+    """
+    Deletes every file under `path` whose name does not match the regex
+    `pattern`, and every symlink. `transform(file_path)` is then called on each
+    kept file, in a pool of `workers` threads (or processes, for CPU-bound
+    transforms) if `workers` is nonzero. Directories whose names are not valid
+    UTF-8 are renamed first, so transforms can write back to a sanitized path.
+    """
+    rexp = re.compile(pattern)
+    kept = []
+    for entry in walk_files(path, fix_dir_names=True):
+        if entry.is_file(follow_symlinks=False) and rexp.search(entry.name):
+            kept.append(entry.path)
+        else:
+            try:
+                os.remove(entry.path)
+            except PermissionError:
+                os.chmod(entry.path, 0o755)
+                os.remove(entry.path)
+
+    if transform is None:
+        return kept
+    if not workers:
+        for file_path in kept:
+            transform(file_path)
+    elif processes:
+        with ProcessPoolExecutor(workers) as executor:
+            for _ in executor.map(transform, kept, chunksize=64):
+                pass
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            for _ in executor.map(transform, kept):
+                pass
+    return kept
+
+
+def batch_loader(seq, size):
+    """
+    Iterator that takes in a list `seq` and returns
+    chunks of size `size`
+    """
+    return [seq[pos:pos + size] for pos in range(0, len(seq), size)]
+
+
+def split_of_key(key, val_rate, salt="proof-pile"):
+    """
+    Stable train/val assignment. The same key always lands in the same split,
+    regardless of which other documents are in the corpus.
+    """
+    digest = hashlib.blake2b(f"{salt}:{key}".encode("utf-8"), digest_size=8).digest()
+    return "val" if int.from_bytes(digest, "big") < val_rate * 2**64 else "train"
+
+
+class JsonlShardWriter:
+    """
+    Writes json lines straight into a .jsonl.gz file, in blocks of roughly
+    `block_size` bytes. The file only appears at `path` once the writer is closed.
+    Documents and bytes written are counted per block, in `metrics`.
+    """
+    def __init__(self, path, block_size=1 << 22, compresslevel=6):
+        self.path = path
+        self.block_size = block_size
+        self.count = 0
+        self._tmp_path = path + ".tmp"
+        self._f = gzip.open(self._tmp_path, "wb", compresslevel=compresslevel)
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, instance):
+        self.write_line(json.dumps(instance) + "\n")
+
+    def write_line(self, line):
+        """
+        `line` is an already serialized instance, ending in a newline.
+        """
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self.count += 1
+        if self._buffered >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            data = "".join(self._buffer).encode("utf-8")
+            self._f.write(data)
+            count("docs_out", len(self._buffer))
+            count("bytes_written", len(data))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._tmp_path)
 
     def __enter__(self):
-        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 
-    def stop(self):
-        self.done = True
-        cols = get_terminal_size((80, 20)).columns
-        print("\r" + " " * cols, end="", flush=True)
-        print(f"\r{self.end}", flush=True)
+class SplitWriter:
+    """
+    A pair of `JsonlShardWriter`s, with each instance sent to train or val by
+    `split_of_key` on its key.
+    """
+    def __init__(self, train_path, val_path, val_rate, **kwargs):
+        self.val_rate = val_rate
+        self.writers = {
+            "train": JsonlShardWriter(train_path, **kwargs),
+            "val": JsonlShardWriter(val_path, **kwargs),
+        }
+
+    def write(self, instance, key):
+        split = split_of_key(key, self.val_rate)
+        self.writers[split].write(instance)
+        return split
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        # handle exceptions with those variables ^
-        self.stop()
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _JsonReader:
+    """
+    A cursor over a text stream that only keeps a window of it in memory.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of json")
+
+    def next(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, c):
+        if self.next() != c:
+            raise ValueError(f"expected {c!r} at offset {self.pos}")
+
+    def value(self):
+        """
+        Decodes one whole json value, reading more of the stream as needed.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue past the end of the buffer
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        """
+        Skips one json value without decoding or buffering it.
+        """
+        if self.peek() not in "{[":
+            self.value()
+            return
+        depth = 0
+        in_string = False
+        escaped = False
+        while True:
+            if self.pos >= len(self.buf) and not self._fill():
+                raise ValueError("unexpected end of json")
+            c = self.buf[self.pos]
+            self.pos += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c in "{[":
+                depth += 1
+            elif c in "}]":
+                depth -= 1
+                if depth == 0:
+                    return
+
+
+_decoder = json.JSONDecoder()
+
+
+def iter_json_arrays(f, targets):
+    """
+    Incrementally parses the json document in the text stream `f`, in the
+    style of ijson. For each key path in `targets`, e.g.
+    `("dataset", "theorems")`, the items of the array at that path are yielded
+    as `(path, item)` as soon as they are read. Everything else is skipped
+    without being decoded, so memory use is about one item.
+    """
+    reader = _JsonReader(f)
+    targets = {tuple(t) for t in targets}
+    prefixes = {t[:i] for t in targets for i in range(len(t))}
+    yield from _iter_json_arrays(reader, (), targets, prefixes)
+
+
+def _iter_json_arrays(reader, path, targets, prefixes):
+    c = reader.peek()
+    if path in targets and c == "[":
+        reader.next()
+        if reader.peek() == "]":
+            reader.next()
+            return
+        while True:
+            yield path, reader.value()
+            if reader.next() == "]":
+                return
+    elif path in prefixes and c == "{":
+        reader.next()
+        if reader.peek() == "}":
+            reader.next()
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            yield from _iter_json_arrays(reader, path + (key,), targets, prefixes)
+            if reader.next() == "}":
+                return
+    else:
+        reader.skip()